@@ -0,0 +1,99 @@
+from __future__ import division
+
+import math
+
+import numpy
+from OpenGL.GL import *
+
+
+class SpriteBatch(object):
+
+    """Draws rabbyt sprites with one glDrawArrays call per texture.
+
+    `add` gathers a sprite's quad into the vertex, texture coordinate and
+    colour lists of its texture, and `draw` copies each list into that
+    texture's float arrays and submits them in a single call.  Textures
+    are drawn in the order they were first added, so a sprite is drawn in
+    front of every sprite of another texture that came before it.  The
+    lists and arrays are kept between frames and only ever grown.
+
+    """
+
+    def __init__(self):
+        # textures added this frame, in the order they were first added
+        self.order = []
+        # texture id -> (vertices, texcoords, colours) lists for this frame
+        self.quads = {}
+        # texture id -> (vertices, texcoords, colours) float32 arrays
+        self.buffers = {}
+
+    def add(self, sprite):
+        texture = sprite.texture_id
+        quads = self.quads.get(texture)
+        if quads is None:
+            quads = self.quads[texture] = ([], [], [])
+        if not quads[0]:
+            self.order.append(texture)
+        vertices, texcoords, colours = quads
+
+        x, y = sprite.x, sprite.y
+        rot, scaleX, scaleY = sprite.rot, sprite.scale_x, sprite.scale_y
+        if rot or scaleX != 1 or scaleY != 1:
+            # the same translate, rotate, scale order rabbyt renders with
+            cos = math.cos(math.radians(rot))
+            sin = math.sin(math.radians(rot))
+            for px, py in sprite.shape:
+                px *= scaleX
+                py *= scaleY
+                vertices.extend((x + px * cos - py * sin,
+                                 y + px * sin + py * cos))
+        else:
+            for px, py in sprite.shape:
+                vertices.extend((x + px, y + py))
+        for u, v in sprite.tex_shape:
+            texcoords.extend((u, v))
+        colours.extend(sprite.rgba * 4)
+
+    def buffersFor(self, texture, count):
+        """Return the arrays of a texture, grown to hold `count` vertices."""
+        buffers = self.buffers.get(texture)
+        if buffers is None or len(buffers[0]) < count * 2:
+            size = 64
+            while size < count:
+                size *= 2
+            buffers = self.buffers[texture] = (
+                numpy.zeros(size * 2, numpy.float32),
+                numpy.zeros(size * 2, numpy.float32),
+                numpy.zeros(size * 4, numpy.float32))
+        return buffers
+
+    def draw(self):
+        """Submit everything added since the last draw and empty the batch."""
+        if not self.order:
+            return
+
+        glEnable(GL_TEXTURE_2D)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+
+        for texture in self.order:
+            quads = self.quads[texture]
+            count = len(quads[0]) // 2
+            buffers = self.buffersFor(texture, count)
+            for array, values in zip(buffers, quads):
+                array[:len(values)] = values
+                del values[:]
+
+            glBindTexture(GL_TEXTURE_2D, texture)
+            glVertexPointer(2, GL_FLOAT, 0, buffers[0])
+            glTexCoordPointer(2, GL_FLOAT, 0, buffers[1])
+            glColorPointer(4, GL_FLOAT, 0, buffers[2])
+            glDrawArrays(GL_QUADS, 0, count)
+
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        # the colour array leaves the current colour undefined
+        glColor4f(1, 1, 1, 1)
+        self.order = []
@@ -1,31 +1,14 @@
-from pygame import Rect
-
-
-class Block:
-
-    def __init__(self, pos):
-        self.name = 'Block'
-
-        self.pos = pos
-        size = 8, 8
-        self.rect = Rect(pos, size)
-
-
-class Platform:
-
-    def __init__(self, pos):
-        self.name = 'Platform'
-
-        self.pos = pos
-        size = 8, 8
-        self.rect = Rect(pos, size)
-
-
-class Step:
-
-    def __init__(self, pos):
-        self.name = 'Step'
-
-        self.pos = pos
-        size = 8, 8
-        self.rect = Rect(pos, size)
+# Tile kinds stored in a level's TileGrid, one byte per tile.
+EMPTY = 0
+BLOCK = 1     # solid from every side
+PLATFORM = 2  # one-way: only catches a character's feet on the way down
+STEP = 3      # lifts a character standing in it onto its top
+
+TILE_SIZE = 8
+
+# layout image colour -> tile kind
+LAYOUT_COLOURS = {
+    (0, 0, 0, 255): BLOCK,
+    (0, 0, 255, 255): PLATFORM,
+    (255, 0, 0, 255): STEP,
+}
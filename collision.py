@@ -0,0 +1,336 @@
+from __future__ import division
+
+from array import array
+
+import numpy
+from pygame import Rect, surfarray
+
+from blocks import EMPTY, BLOCK, PLATFORM, STEP, TILE_SIZE
+
+
+def sweptContact(x, y, width, height, dx, dy, box):
+    """Return when a box moving by (dx, dy) first touches `box`.
+
+    The result is `(time, normalX, normalY)` with `time` between 0 and 1
+    as a fraction of the move, or None if the move misses `box`.  Boxes
+    that already overlap at the start are ignored, so a box can always
+    move out of geometry it is stuck in.
+
+    """
+    if dx > 0:
+        entryX = (box.left - x - width) / dx
+        exitX = (box.right - x) / dx
+    elif dx < 0:
+        entryX = (box.right - x) / dx
+        exitX = (box.left - x - width) / dx
+    elif box.left < x + width and x < box.right:
+        entryX, exitX = float('-inf'), float('inf')
+    else:
+        return None
+
+    if dy > 0:
+        entryY = (box.top - y - height) / dy
+        exitY = (box.bottom - y) / dy
+    elif dy < 0:
+        entryY = (box.bottom - y) / dy
+        exitY = (box.top - y - height) / dy
+    elif box.top < y + height and y < box.bottom:
+        entryY, exitY = float('-inf'), float('inf')
+    else:
+        return None
+
+    entry = max(entryX, entryY)
+    if entry >= min(exitX, exitY) or not 0 <= entry <= 1:
+        return None
+    # on an exact corner the vertical contact wins, so boxes land on ledges
+    if entryX > entryY:
+        return entry, -1 if dx > 0 else 1, 0
+    return entry, 0, -1 if dy > 0 else 1
+
+
+class TileGrid(object):
+
+    """The static world as a row-major array of one-byte tile kinds.
+
+    Collision queries turn a rect into the range of tiles beneath it with
+    integer division and read those bytes directly, so their cost depends
+    on the size of the rect and not on the size of the level.  Rects are
+    only built for the tiles a query actually hits.
+
+    `merge` additionally covers the tiles with as few same-kind rectangles
+    as it can find, which `sweep` answers queries from.  Call it again
+    after changing tiles with `set`.
+
+    """
+
+    def __init__(self, width, height, tileSize=TILE_SIZE):
+        self.width = width
+        self.height = height
+        self.tileSize = tileSize
+        self.tiles = array('B', [EMPTY]) * (width * height)
+
+        # merged (kind, Rect) pairs, and for every tile the index + 1 of the
+        # merged rect covering it, or 0 for empty tiles
+        self.rects = []
+        self.rectIds = array('I', [0]) * (width * height)
+
+    @classmethod
+    def fromLayout(cls, layout, colours):
+        """Build a grid from a layout image holding one pixel per tile.
+
+        `colours` maps RGBA colours to tile kinds and every other pixel is
+        left empty.  Each colour is matched against the whole pixel array
+        at once instead of reading the image pixel by pixel.
+
+        """
+        width, height = layout.get_size()
+        rgb = surfarray.array3d(layout)
+        alpha = surfarray.array_alpha(layout)
+
+        kinds = numpy.zeros((width, height), numpy.uint8)
+        for (red, green, blue, opacity), kind in colours.iteritems():
+            match = ((rgb[:, :, 0] == red) & (rgb[:, :, 1] == green) &
+                     (rgb[:, :, 2] == blue) & (alpha == opacity))
+            kinds[match] = kind
+
+        grid = cls(width, height)
+        # surfarray indexes by column first; the grid is stored row by row
+        grid.tiles = array('B', kinds.T.tostring())
+        return grid
+
+    def get(self, column, row):
+        if 0 <= column < self.width and 0 <= row < self.height:
+            return self.tiles[row * self.width + column]
+        return EMPTY
+
+    def set(self, column, row, kind):
+        self.tiles[row * self.width + column] = kind
+
+    def merge(self):
+        """Greedily cover the non-empty tiles with same-kind rectangles.
+
+        Scanning rows top to bottom, each unclaimed tile starts a run that
+        grows right while the kind matches, then grows down while the
+        whole run below is the same kind.
+
+        """
+        tiles = self.tiles
+        width = self.width
+        size = self.tileSize
+        rects = []
+        rectIds = array('I', [0]) * (width * self.height)
+        grid = numpy.frombuffer(tiles, numpy.uint8)
+        grid = grid.reshape(self.height, width)
+
+        for row in xrange(self.height):
+            start = row * width
+            end = 0
+            # only visit the non-empty tiles of the row
+            for column in numpy.flatnonzero(grid[row]).tolist():
+                if column < end or rectIds[start + column]:
+                    continue
+                kind = tiles[start + column]
+
+                end = column + 1
+                while (end < width and tiles[start + end] == kind and
+                       not rectIds[start + end]):
+                    end += 1
+                run = tiles[start + column:start + end]
+
+                bottom = row + 1
+                while bottom < self.height:
+                    below = bottom * width
+                    if tiles[below + column:below + end] != run:
+                        break
+                    bottom += 1
+
+                rects.append((kind, Rect(column * size, row * size,
+                                         (end - column) * size,
+                                         (bottom - row) * size)))
+                claimed = array('I', [len(rects)]) * (end - column)
+                for r in xrange(row, bottom):
+                    rectIds[r * width + column:r * width + end] = claimed
+
+        self.rects = rects
+        self.rectIds = rectIds
+
+    def tileRange(self, rect):
+        """Return the first and last column and row under `rect`."""
+        size = self.tileSize
+        left = max(rect.left // size, 0)
+        top = max(rect.top // size, 0)
+        right = min((rect.right - 1) // size, self.width - 1)
+        bottom = min((rect.bottom - 1) // size, self.height - 1)
+        return left, top, right, bottom
+
+    def collide(self, rect):
+        """Return `(kind, rect)` for every non-empty tile under `rect`."""
+        tiles = self.tiles
+        width = self.width
+        size = self.tileSize
+        left, top, right, bottom = self.tileRange(rect)
+        count = right - left + 1
+        collided = []
+        for row in xrange(top, bottom + 1):
+            start = row * width + left
+            span = tiles[start:start + count]
+            if span.count(EMPTY) == count:
+                continue
+            for offset, kind in enumerate(span):
+                if kind != EMPTY:
+                    collided.append((kind, Rect((left + offset) * size,
+                                                row * size, size, size)))
+        return collided
+
+    def mergedUnder(self, rect):
+        """Return the merged `(kind, Rect)` pairs with a tile under `rect`."""
+        rects = self.rects
+        rectIds = self.rectIds
+        width = self.width
+        left, top, right, bottom = self.tileRange(rect)
+        count = right - left + 1
+
+        found = set()
+        for row in xrange(top, bottom + 1):
+            start = row * width + left
+            found.update(rectIds[start:start + count])
+        found.discard(0)
+        return [rects[index - 1] for index in found]
+
+    def sweep(self, x, y, width, height, dx, dy, platforms=True):
+        """Move a box by (dx, dy) through the level in a single query.
+
+        Returns the new `(x, y, normalX, normalY)`.  The normals are -1, 0
+        or 1 and name the side the box was stopped from: normalY == -1
+        means it landed, normalX == 1 means it hit a wall on its left.
+        After a contact the box slides along it for the rest of the move.
+
+        Blocks stop the box from every side.  A platform only catches the
+        box on the way down, at the bottom of its top row of tiles, and is
+        ignored when `platforms` is false so a character can drop through.
+        A box moving down that ends inside steps is lifted onto the
+        highest one, so characters can walk up them.
+
+        """
+        size = self.tileSize
+        falling = dy >= 0
+        area = Rect(int(min(x, x + dx)) - 1, int(min(y, y + dy)) - 1,
+                    int(width + abs(dx)) + 3, int(height + abs(dy)) + 3)
+
+        blocks = []
+        surfaces = []
+        for kind, merged in self.mergedUnder(area):
+            if kind == BLOCK:
+                blocks.append(merged)
+            elif kind == PLATFORM and platforms:
+                surfaces.append(merged)
+
+        normalX = normalY = 0
+        # a move can be stopped at most once per axis
+        for attempt in xrange(3):
+            if not dx and not dy:
+                break
+
+            first = None
+            for box in blocks:
+                contact = sweptContact(x, y, width, height, dx, dy, box)
+                if contact and (first is None or contact[0] < first[0]):
+                    first = contact + (box,)
+
+            if dy > 0:
+                bottom = y + height
+                for platform in surfaces:
+                    surface = platform.top + size
+                    if not bottom <= surface <= bottom + dy:
+                        continue
+                    time = (surface - bottom) / dy
+                    left = x + dx * time
+                    if (left < platform.right and
+                            left + width > platform.left and
+                            (first is None or time < first[0])):
+                        first = time, 0, -1, Rect(platform.left, surface,
+                                                  platform.width, 0)
+
+            if first is None:
+                x += dx
+                y += dy
+                break
+
+            time, hitX, hitY, box = first
+            if hitX:
+                x = box.right if hitX > 0 else box.left - width
+                y += dy * time
+                dx = 0
+                dy *= 1 - time
+                normalX = hitX
+            else:
+                x += dx * time
+                y = box.bottom if hitY > 0 else box.top - height
+                dx *= 1 - time
+                dy = 0
+                normalY = hitY
+
+        if falling:
+            steps = [tile for kind, tile
+                     in self.collide(Rect(x, y, width, height))
+                     if kind == STEP]
+            if steps:
+                y = min(step.top for step in steps) + size - height
+                normalY = -1
+
+        return x, y, normalX, normalY
+
+
+class SweepAndPrune(object):
+
+    """Broad phase for the moving entities, rebuilt every tick.
+
+    All character and projectile boxes are sorted by their left edge.
+    Each character then only looks at the sorted run of boxes that can
+    reach it along x, filters that run by overlap on both axes, and
+    reports what is left as candidate pairs in `pairs`.  Projectiles are
+    never paired with each other, so a crowd of knives costs a sort and
+    not a quadratic scan.
+
+    """
+
+    def __init__(self):
+        # (character, character or projectile model) candidate pairs
+        self.pairs = []
+
+    def update(self, characters, projectiles):
+        count = len(characters)
+        entities = list(characters) + projectiles.models
+
+        left, top, right, bottom = projectiles.rects()
+        if count:
+            boxes = numpy.array([(c.rect.left, c.rect.top, c.rect.right,
+                                  c.rect.bottom) for c in characters])
+            left = numpy.concatenate((boxes[:, 0], left))
+            top = numpy.concatenate((boxes[:, 1], top))
+            right = numpy.concatenate((boxes[:, 2], right))
+            bottom = numpy.concatenate((boxes[:, 3], bottom))
+
+        pairs = []
+        if count and len(entities) > 1:
+            order = numpy.argsort(left, kind='mergesort')
+            sortedLeft = left[order]
+            widest = (right - left).max()
+
+            for index in xrange(count):
+                # only boxes starting within `widest` of this one can reach
+                # it from the left
+                start = sortedLeft.searchsorted(left[index] - widest, 'right')
+                end = sortedLeft.searchsorted(right[index], 'left')
+                run = order[start:end]
+                run = run[(right[run] > left[index]) &
+                          (top[run] < bottom[index]) &
+                          (bottom[run] > top[index])]
+                for other in run:
+                    # report each pair of characters once
+                    if other < count and other <= index:
+                        continue
+                    pairs.append((entities[index], entities[other]))
+
+        self.pairs = pairs
+        return pairs
@@ -1,8 +1,54 @@
+eventTypes = []  # every event class, indexed by its typeCode
+
+# Each tick the EventManager dispatches queued events phase by phase, in
+# this order.  An event class picks its phase with the `phase` attribute.
+PHASES = ('input', 'simulation', 'view', 'render')
+
+
+class EventType(type):
+
+    """Metaclass for events.
+
+    Gives every event class a `typeCode` integer, a class-level `name` and
+    the `phaseIndex` of its phase, and turns its `attributes` into
+    `__slots__` so that instances carry no per-instance dictionary.
+
+    """
+
+    def __new__(meta, name, bases, namespace):
+        attributes = namespace.get('attributes', ())
+        namespace.setdefault('__slots__', tuple(attributes))
+        cls = type.__new__(meta, name, bases, namespace)
+        cls.typeCode = len(eventTypes)
+        cls.name = name
+        cls.phaseIndex = PHASES.index(cls.phase)
+        cls.pool = []
+        eventTypes.append(cls)
+        return cls
+
+
 class Event(object):
 
     """Base abstract class for events used by Listeners to communicate."""
+    __metaclass__ = EventType
+
     attributes = ()
     to_log = True  # Set to False in subclasses to avoid flooding the log.
+    phase = 'simulation'
+
+    # Set to True in subclasses that end a frame or step: posting one makes
+    # the EventManager dispatch everything queued so far.
+    flush = False
+
+    # Set to True in subclasses that are posted every tick, and create them
+    # with `acquire` instead of calling the class.
+    pooled = False
+    poolLimit = 256
+
+    # Set to True in subclasses where only the latest event per
+    # `coalesceKey` matters; the EventManager then replaces a still
+    # queued event with the same key instead of queueing another one.
+    coalesces = False
 
     def __init__(self, *args):
         """Create a new event.
@@ -20,6 +66,30 @@ class Event(object):
         for name, value in pairs:
             setattr(self, name, value)
 
+    @classmethod
+    def acquire(cls, *args, **kwargs):
+        """Return a recycled instance of a pooled event class.
+
+        Falls back to creating a new event when the pool is empty.  The
+        EventManager hands pooled events back with `release` once they
+        have been dispatched, so listeners must not hold on to them.
+
+        """
+        pool = cls.pool
+        if pool:
+            event = pool.pop()
+            event.__init__(*args, **kwargs)
+            return event
+        return cls(*args, **kwargs)
+
+    def release(self):
+        pool = self.pool
+        if len(pool) < self.poolLimit:
+            pool.append(self)
+
+    def coalesceKey(self):
+        return self.typeCode
+
     def __repr__(self):
         pieces = []
         for attr_name in self.attributes:
@@ -38,228 +108,296 @@ class Event(object):
 
 
 class TickEvent(Event):
+    phase = 'input'
+    pooled = True
+    flush = True
 
-    def __init__(self, fps=0):
-        self.name = 'TickEvent'
-        self.fps = fps
+    def __init__(self):
+        pass
 
 
 class DrawEvent(Event):
+    attributes = ('alpha', 'fps')
+    phase = 'render'
+    pooled = True
+    flush = True
 
-    def __init__(self):
-        self.name = 'DrawEvent'
+    def __init__(self, alpha=1.0, fps=0):
+        self.alpha = alpha
+        self.fps = fps
 
 
 class GameStartEvent(Event):
+    phase = 'input'
 
     def __init__(self):
-        self.name = "GameStartEvent"
+        pass
 
 
 class GamePauseEvent(Event):
+    phase = 'input'
 
     def __init__(self):
-        self.name = "GamePauseEvent"
+        pass
 
 
 class GamePausedEvent(Event):
+    phase = 'input'
+    pooled = True
 
     def __init__(self):
-        self.name = "GamePausedEvent"
+        pass
 
 
 class GameRunningEvent(Event):
+    phase = 'input'
+    pooled = True
+
+    def __init__(self):
+        pass
+
+
+class TraceDumpRequest(Event):
+    phase = 'input'
 
     def __init__(self):
-        self.name = "GameRunningEvent"
+        pass
+
+
+class GameUpdateEvent(Event):
+    pooled = True
+
+    def __init__(self):
+        pass
 
 
 class PlayerUpdateEvent(Event):
 
     def __init__(self):
-        self.name = "PlayerUpdateEvent"
+        pass
 
 
 class PlayerJoinRequest(Event):
+    attributes = ('playerData',)
+    phase = 'input'
 
     def __init__(self, playerData):
-        self.name = "PlayerJoinRequest"
         self.playerData = playerData
 
 
 class PlayerJoinEvent(Event):
+    attributes = ('player',)
 
     def __init__(self, player):
-        self.name = "PlayerJoinEvent"
         self.player = player
 
 
 class CharacterAddRequest(Event):
+    attributes = ('pos',)
+    phase = 'input'
 
     def __init__(self, pos):
-        self.name = "CharacterAddRequest"
         self.pos = pos
 
 
 class CharacterAddEvent(Event):
 
     def __init__(self):
-        self.name = "CharacterAddEvent"
+        pass
 
 
 class CharacterUpdateRequest(Event):
 
     def __init__(self):
-        self.name = "CharacterUpdateRequest"
+        pass
 
 
 class CharacterUpdateEvent(Event):
+    attributes = ('rect',)
+    phase = 'view'
+    pooled = True
 
     def __init__(self, rect):
-        self.name = "CharacterUpdateEvent"
         self.rect = rect
 
 
 class CharacterWalkRequest(Event):
+    attributes = ('direction',)
+    phase = 'input'
+    pooled = True
 
     def __init__(self, direction):
-        self.name = "CharacterWalkRequest"
         self.direction = direction
 
 
 class CharacterSetImage(Event):
+    attributes = ('character', 'frame', 'action')
+    phase = 'view'
+    pooled = True
+    coalesces = True
 
-    def __init__(self, frame, action):
-        self.name = "CharacterSetImage"
+    def __init__(self, character, frame, action):
+        self.character = character
         self.frame = frame
         self.action = action
 
+    def coalesceKey(self):
+        return self.typeCode, self.character
+
 
 class CharacterJumpRequest(Event):
+    phase = 'input'
 
     def __init__(self):
-        self.name = "CharacterJumpRequest"
+        pass
 
 
 class CharacterDropEvent(Event):
+    phase = 'input'
 
     def __init__(self):
-        self.name = "CharacterDropEvent"
+        pass
 
 
 class CharacterPunchRequest(Event):
+    phase = 'input'
 
     def __init__(self):
-        self.name = "CharacterPunchRequest"
-
-
-class CharacterCollideRequest(Event):
-
-    def __init__(self, direction):
-        self.name = "CharacterCollideRequest"
-        self.direction = direction
-
-
-class CharacterCollideEvent(Event):
-
-    def __init__(self, direction, entities):
-        self.name = "CharacterCollideEvent"
-        self.direction = direction
-        self.entities = entities
+        pass
 
 
 class ProjectileAddEvent(Event):
+    attributes = ('projectile',)
 
     def __init__(self, projectile):
-        self.name = "ProjectileAddEvent"
         self.projectile = projectile
 
 
 class SpritemodelAddEvent(Event):
+    attributes = ('model', 'pos')
+    phase = 'view'
 
     def __init__(self, model, pos):
-        self.name = "SpritemodelAddEvent"
         self.model = model
         self.pos = pos
 
 
 class SpriteAddEvent(Event):
+    attributes = ('sprite', 'pos')
+    phase = 'view'
 
     def __init__(self, sprite, pos):
-        self.name = "SpriteAddEvent"
         self.sprite = sprite
         self.pos = pos
 
 
 class SpriteKillEvent(Event):
+    attributes = ('model', 'pos')
+    phase = 'view'
 
     def __init__(self, model, pos):
-        self.name = "SpriteKillEvent"
         self.model = model
         self.pos = pos
 
 
 class ProjectileUpdateEvent(Event):
+    attributes = ('projectiles',)
+    phase = 'view'
+    pooled = True
+    coalesces = True
 
-    def __init__(self, projectile):
-        self.name = "ProjectileUpdateEvent"
-        self.projectile = projectile
+    def __init__(self, projectiles):
+        self.projectiles = projectiles
 
 
 class AbilityUseEvent(Event):
+    attributes = ('ability',)
+    phase = 'input'
 
     def __init__(self, ability):
-        self.name = "AbilityUseEvent"
         self.ability = ability
 
 
+class AbilitiesAddEvent(Event):
+    attributes = ('abilities',)
+
+    def __init__(self, abilities):
+        self.abilities = abilities
+
+
+class AbilityCooldownEvent(Event):
+    attributes = ('index', 'remaining')
+    phase = 'view'
+    pooled = True
+    coalesces = True
+
+    def __init__(self, index, remaining):
+        self.index = index
+        self.remaining = remaining
+
+    def coalesceKey(self):
+        return self.typeCode, self.index
+
+
 class AbilityDashEvent(Event):
+    attributes = ('direction',)
 
     def __init__(self, direction):
-        self.name = "AbilityDashEvent"
         self.direction = direction
 
 
 class BuffAddEvent(Event):
+    attributes = ('buff',)
 
     def __init__(self, buff):
-        self.name = 'BuffAddEvent'
         self.buff = buff
 
 
 class CharacterKillEvent(Event):
 
     def __init__(self):
-        self.name = "CharacterKillEvent"
+        pass
 
 
 class LevelBuildRequest(Event):
+    attributes = ('level',)
 
-    def __init__(self, layout, backgrounds):
-        self.name = "LevelBuildRequest"
-        self.layout = layout
-        self.backgrounds = backgrounds
+    def __init__(self, level):
+        self.level = level
+
+
+class LevelPrefetchRequest(Event):
+    attributes = ('level',)
+
+    def __init__(self, level):
+        self.level = level
 
 
 class LevelBuildEvent(Event):
+    attributes = ('tiles', 'backgrounds')
 
-    def __init__(self, layout, backgrounds):
-        self.name = "LevelBuildEvent"
-        self.layout = layout
+    def __init__(self, tiles, backgrounds):
+        self.tiles = tiles
         self.backgrounds = backgrounds
 
 
 class CameraMoveEvent(Event):
+    attributes = ('topleft',)
+    phase = 'view'
+    pooled = True
+    coalesces = True
 
     def __init__(self, topleft):
-        self.name = "CameraMoveEvent"
         self.topleft = topleft
 
 
 class CameraCenterRequest(Event):
+    attributes = ('pos', 'xscroll', 'yscroll')
+    phase = 'view'
+    pooled = True
+    coalesces = True
 
     def __init__(self, pos, xscroll=True, yscroll=True):
-        self.name = "CameraCenterRequest"
         self.pos = pos
         self.xscroll = xscroll
         self.yscroll = yscroll
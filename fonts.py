@@ -1,4 +1,7 @@
 from __future__ import division
+import json
+import os
+import numpy
 import rabbyt
 import pygame
 from OpenGL.GL import *
@@ -17,9 +20,361 @@ def next_power_of_2(v):
     v |= v >> 16
     return v + 1
 
+CACHE_DIR = os.path.join('cache', 'fonts')
+
+class AtlasPage(object):
+    """
+    ``AtlasPage(size, [surface, skyline])``
+
+    One square texture of a ``GlyphAtlas``, filled by skyline packing.
+
+    The skyline is the lower edge of everything packed so far, stored as
+    ``(x, y, width)`` segments from left to right with ``y`` growing down
+    the page.  Each rectangle goes where its bottom edge ends up highest,
+    so the page fills from the top with little wasted space, whatever the
+    widths of the glyphs.
+    """
+    def __init__(self, size, surface=None, skyline=None):
+        self.size = size
+        if surface is None:
+            surface = pygame.Surface((size, size), pygame.SRCALPHA, 32)
+        self.surface = surface
+        self.skyline = skyline or [(0, 0, size)]
+        # the cache file holding the page as last saved, and whether
+        # glyphs were drawn on it since
+        self.file = None
+        self.revision = 0
+        self.dirty = False
+        self._texture_id = None
+
+    def _fit(self, skyline, index, w, h):
+        # the y a w x h rectangle rests at on the segments from index, or
+        # None if it doesn't fit there
+        x = skyline[index][0]
+        if x + w > self.size:
+            return None
+        y = 0
+        while w > 0:
+            seg_x, seg_y, seg_w = skyline[index]
+            y = max(y, seg_y)
+            if y + h > self.size:
+                return None
+            w -= seg_x + seg_w - x
+            x = seg_x + seg_w
+            index += 1
+        return y
+
+    def _place(self, skyline, index, x, y, w, h):
+        skyline.insert(index, (x, y+h, w))
+        right = x + w
+        # cut away the segments the new one covers
+        index += 1
+        while index < len(skyline):
+            seg_x, seg_y, seg_w = skyline[index]
+            if seg_x >= right:
+                break
+            if seg_x + seg_w <= right:
+                del skyline[index]
+                continue
+            skyline[index] = (right, seg_y, seg_x + seg_w - right)
+            break
+        # and join neighbours at the same height
+        index = 0
+        while index < len(skyline) - 1:
+            seg_x, seg_y, seg_w = skyline[index]
+            if seg_y == skyline[index+1][1]:
+                skyline[index] = (seg_x, seg_y, seg_w + skyline[index+1][2])
+                del skyline[index+1]
+            else:
+                index += 1
+
+    def pack(self, sizes):
+        """
+        ``pack(sizes)``
+
+        Finds room for rectangles of the given ``(width, height)`` sizes
+        and returns their ``(x, y)`` positions in the same order.  If they
+        don't all fit, nothing is packed and ``None`` is returned.
+        """
+        skyline = list(self.skyline)
+        positions = [None]*len(sizes)
+        # tallest first, so short glyphs fill the gaps beside tall ones
+        for n in sorted(xrange(len(sizes)), key=lambda n: -sizes[n][1]):
+            w, h = sizes[n]
+            best = None
+            for index in xrange(len(skyline)):
+                y = self._fit(skyline, index, w, h)
+                if y is None:
+                    continue
+                score = (y + h, skyline[index][0])
+                if best is None or score < best[0]:
+                    best = (score, index, y)
+            if best is None:
+                return None
+            (bottom, x), index, y = best
+            self._place(skyline, index, x, y, w, h)
+            positions[n] = (x, y)
+        self.skyline = skyline
+        return positions
+
+    def _get_texture_id(self):
+        if self._texture_id is None:
+            data = pygame.image.tostring(self.surface, "RGBA", True)
+            self._texture_id = rabbyt.load_texture(
+                    data, (self.size, self.size), "RGBA", True, False)
+        return self._texture_id
+    texture_id = property(_get_texture_id, doc=
+        """
+        The id of the OpenGL texture of this page, loaded when it is first
+        asked for.
+        """)
+
+    def upload(self):
+        """
+        ``upload()``
+
+        Copies the page into its texture after more glyphs were drawn on
+        it.
+        """
+        if self._texture_id is None:
+            return
+        data = pygame.image.tostring(self.surface, "RGBA", True)
+        glBindTexture(GL_TEXTURE_2D, self._texture_id)
+        glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, self.size, self.size,
+                        GL_RGBA, GL_UNSIGNED_BYTE, data)
+
+    def free(self):
+        """
+        ``free()``
+
+        Unloads the page's texture.  It is loaded again if asked for.
+        """
+        if self._texture_id is not None:
+            rabbyt.unload_texture(self._texture_id)
+            self._texture_id = None
+
+class GlyphAtlas(object):
+    """
+    ``GlyphAtlas([page_size, cache_dir])``
+
+    Holds the glyphs of every font, at every size, in as few textures as
+    possible.
+
+    Each font's glyphs are packed onto the first ``AtlasPage`` with room
+    for all of them, and a new page is started when none has.  Fonts added
+    with a key are remembered along with their metrics, and the pages and
+    metrics are written to ``cache_dir`` so the next start loads the
+    glyphs instead of rendering them again.  Fonts added without a key
+    are only packed once per ``pygame.font.Font`` and alphabet.
+    """
+    version = 2
+
+    def __init__(self, page_size=1024, cache_dir=CACHE_DIR):
+        self.page_size = page_size
+        self.cache_dir = cache_dir
+        self.pages = []
+        # key -> (page index, metrics)
+        self.fonts = {}
+        # (pygame_font, alphabet) -> (page, metrics) of fonts without a key
+        self._unkeyed = {}
+        self._loaded = False
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, 'atlas.json')
+
+    def load(self):
+        """
+        ``load()``
+
+        Reads the pages and fonts saved in ``cache_dir``.  A missing or
+        unreadable cache leaves the atlas empty.
+        """
+        self._loaded = True
+        try:
+            with open(self._index_path()) as f:
+                index = json.load(f)
+            if index['version'] != self.version:
+                return
+            pages = []
+            for saved in index['pages']:
+                path = os.path.join(self.cache_dir, saved['file'])
+                surface = pygame.image.load(path)
+                if surface.get_size() != (saved['size'], saved['size']):
+                    return
+                page = AtlasPage(saved['size'], surface,
+                                 [tuple(s) for s in saved['skyline']])
+                page.file = saved['file']
+                page.revision = saved['revision']
+                pages.append(page)
+            fonts = dict((key, tuple(font))
+                         for key, font in index['fonts'].iteritems())
+        except (EnvironmentError, ValueError, KeyError, pygame.error):
+            return
+        self.pages = pages
+        self.fonts = fonts
+
+    def save(self):
+        """
+        ``save()``
+
+        Writes the pages that changed since they were last saved, then the
+        index of fonts and pages.  Changed pages go to new files and the
+        old ones are only removed once the new index is in place, so an
+        interrupted save leaves the previous cache intact.
+        """
+        files = {}
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            for n, page in enumerate(self.pages):
+                if page.dirty or page.file is None:
+                    files[page] = 'page%d.%d.png' % (n, page.revision + 1)
+                    pygame.image.save(
+                            page.surface,
+                            os.path.join(self.cache_dir, files[page]))
+
+            index = {'version': self.version, 'fonts': self.fonts,
+                     'pages': [{'size': page.size, 'skyline': page.skyline,
+                                'file': files.get(page, page.file),
+                                'revision': page.revision + (page in files)}
+                               for page in self.pages]}
+            partial = '%s.%d.tmp' % (self._index_path(), os.getpid())
+            with open(partial, 'w') as f:
+                json.dump(index, f)
+            os.rename(partial, self._index_path())
+        except (EnvironmentError, pygame.error):
+            return  # a read-only tree still runs, it just renders every start
+
+        for page, name in files.iteritems():
+            old = page.file
+            page.file = name
+            page.revision += 1
+            page.dirty = False
+            if old is not None:
+                try:
+                    os.remove(os.path.join(self.cache_dir, old))
+                except EnvironmentError:
+                    pass
+
+    def find(self, key):
+        """
+        ``find(key)``
+
+        Returns ``(page, metrics)`` for a font added under ``key``, or
+        ``None``.
+        """
+        if not self._loaded:
+            self.load()
+        if key not in self.fonts:
+            return None
+        page, metrics = self.fonts[key]
+        return self.pages[page], metrics
+
+    def add(self, pygame_font, alphabet, key=None):
+        """
+        ``add(pygame_font, alphabet, [key])``
+
+        Renders the characters of ``alphabet`` onto a page and returns
+        ``(page, metrics)``.  The metrics hold the font's ``height`` and
+        ``space_width``, and its ``glyphs`` as ``char: (x, y, width)``
+        pixel positions on the page.  A font added with a ``key`` is saved
+        to the cache.
+        """
+        if not self._loaded:
+            self.load()
+        if key is None and (pygame_font, alphabet) in self._unkeyed:
+            return self._unkeyed[pygame_font, alphabet]
+        height = pygame_font.size(" ")[1]
+        widths = [pygame_font.size(char)[0] for char in alphabet]
+        # a pixel of padding keeps filtering from bleeding between glyphs
+        sizes = [(w+1, height+1) for w in widths]
+
+        for n, page in enumerate(self.pages):
+            positions = page.pack(sizes)
+            if positions:
+                break
+        else:
+            size = self.page_size
+            while True:
+                page = AtlasPage(size)
+                positions = page.pack(sizes)
+                if positions:
+                    break
+                size *= 2
+            n = len(self.pages)
+            self.pages.append(page)
+
+        glyphs = {}
+        for char, w, (x, y) in zip(alphabet, widths, positions):
+            page.surface.blit(
+                    pygame_font.render(char, True, (255,255,255)), (x,y))
+            glyphs[char] = (x, y, w)
+        page.dirty = True
+        page.upload()
+
+        metrics = {'height': height,
+                   'space_width': pygame_font.size(" ")[0],
+                   'glyphs': glyphs}
+        if key is not None:
+            self.fonts[key] = (n, metrics)
+            self.save()
+        else:
+            self._unkeyed[pygame_font, alphabet] = (page, metrics)
+        return page, metrics
+
+    def free(self):
+        """
+        ``free()``
+
+        Unloads the textures of every page and forgets every font, for an
+        atlas that is no longer needed.  Fonts drawn from the atlas can't
+        be used afterwards.  The cache on disk is left alone.
+        """
+        for page in self.pages:
+            page.free()
+        self.pages = []
+        self.fonts = {}
+        self._unkeyed = {}
+        self._loaded = False
+
+# every Font draws its glyphs from here unless given another atlas
+shared_atlas = GlyphAtlas()
+
+# (filename, size, alphabet) -> Font, see get_font
+_fonts = {}
+
+def _font_key(filename, size, alphabet):
+    # names the font file's contents as far as the modification time and
+    # size can tell, so an edited font isn't loaded from the cache
+    path = filename
+    if path is None:
+        path = os.path.join(os.path.dirname(pygame.font.__file__),
+                            pygame.font.get_default_font())
+    try:
+        stat = os.stat(path)
+        stamp = (stat.st_size, int(stat.st_mtime))
+    except (EnvironmentError, TypeError):
+        stamp = None
+    return repr((path, size, alphabet, stamp, pygame.version.ver))
+
+def get_font(filename, size, alphabet=default_alphabet):
+    """
+    ``get_font(filename, size, [alphabet])``
+
+    Returns the ``Font`` for a font file and point size, as
+    ``pygame.font.Font`` takes them.  Every caller asking for the same font
+    shares it, and its glyphs are rendered into the shared atlas only the
+    first time the font is asked for on this machine.
+    """
+    key = (filename, size, alphabet)
+    if key not in _fonts:
+        _fonts[key] = Font(pygame.font.Font(filename, size), alphabet,
+                           key=_font_key(filename, size, alphabet))
+    return _fonts[key]
+
 class Font(object):
     """
-    ``Font(pygame_font, [alphabet])``
+    ``Font(pygame_font, [alphabet, atlas, key])``
 
     Holds the information for drawing a font.
 
@@ -32,47 +387,42 @@ class Font(object):
 
     To actually draw a font you need to use a ``FontSprite``.
 
-    The characters will be rendered onto an OpenGL texture.
+    The characters are rendered into ``atlas``, which defaults to the
+    ``shared_atlas``, and share its textures with the other fonts.  If
+    ``key`` is given and the atlas already holds a font under it, that
+    font's glyphs are used without rendering anything.  The textures are
+    unloaded by ``atlas.free()``.
     """
-    def __init__(self, pygame_font, alphabet=default_alphabet):
+    def __init__(self, pygame_font, alphabet=default_alphabet, atlas=None,
+                 key=None):
         self.pygame_font = pygame_font
         self.alphabet = alphabet
-        widest = max(self.pygame_font.size(char)[0]+1 for char in alphabet)
-        height = self.pygame_font.size(" ")[1]
+        if atlas is None:
+            atlas = shared_atlas
 
-        total_area = widest*height*len(self.alphabet)
-        sw = sh = total_area**.5
-        sw += widest
-        sh += height
-        sw = next_power_of_2(sw)
-        sh = next_power_of_2(sh)
-
-        surface = pygame.Surface((sw, sh), pygame.SRCALPHA, 32)
+        found = atlas.find(key) if key is not None else None
+        if found is None:
+            found = atlas.add(pygame_font, alphabet, key)
+        self.page, metrics = found
+        height = metrics['height']
 
+        size = self.page.size
         self.coords = {}
-        x=0
-        y=0
-        for char in alphabet:
-            w = self.pygame_font.size(char)[0]
-            self.coords[char] = (x/sw, 1-y/sh, (x+w)/sw, 1-(y+height)/sh)
-            surface.blit(
-                    self.pygame_font.render(char, True, (255,255,255)), (x,y))
-            x += widest
-            if x + widest > sw:
-                y += height
-                x = 0
-
-        data = pygame.image.tostring(surface, "RGBA", True)
-        self._texture_id = rabbyt.load_texture(data, (sw, sh))
+        self.widths = {}
+        for char, (x, y, w) in metrics['glyphs'].iteritems():
+            self.coords[char] = (x/size, 1-y/size, (x+w)/size,
+                                 1-(y+height)/size)
+            self.widths[char] = w
+
         self.height = height
-        self.space_width = pygame_font.size(" ")[0]
+        self.space_width = metrics['space_width']
 
     def _get_texture_id(self):
-        return self._texture_id
+        return self.page.texture_id
     texture_id = property(_get_texture_id, doc=
         """
-        This is the id of the OpenGL texture for this font.  The texture will
-        be unloaded when the font is garbage collected.
+        This is the id of the OpenGL texture holding this font's glyphs.
+        It is shared with the other fonts on the same atlas page.
         """)
 
     def get_char_tex_shape(self, char):
@@ -92,43 +442,100 @@ class Font(object):
 
         Returns the width in pixels of the given character.
         """
+        if char in self.widths:
+            return self.widths[char]
         return self.pygame_font.size(char)[0]
 
-    def __del__(self):
-        if rabbyt:
-            rabbyt.unload_texture(self.texture_id)
-
 class FontSprite(rabbyt.BaseSprite):
+    """
+    ``FontSprite(font, text, **kwargs)``
+
+    Draws a string in a ``Font``.
+
+    The glyph quads of the string are packed into one vertex array and one
+    texture coordinate array, which are drawn with a single call.  Setting
+    ``text`` only lays out the glyphs from the first character that
+    changed, and the arrays are reused as long as they are big enough.
+    """
 
     def __init__(self, font, text, **kwargs):
         rabbyt.BaseSprite.__init__(self, **kwargs)
         self.font = font
         self.texture_id = font.texture_id
+        self._text = ''
+        # for every character of the text, the x it starts at and the
+        # number of quads before it
+        self._layout = []
+        self._width = 0
+        self._quad_count = 0
+        self._vertices = numpy.zeros(0, numpy.float32)
+        self._tex_coords = numpy.zeros(0, numpy.float32)
         self.text = text
         glBindTexture(GL_TEXTURE_2D, self.texture_id)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
         glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
-        
+
+    def _reserve(self, quads):
+        if len(self._vertices) < quads*8:
+            size = max(quads*8, len(self._vertices)*2, 64)
+            vertices = numpy.zeros(size, numpy.float32)
+            tex_coords = numpy.zeros(size, numpy.float32)
+            vertices[:len(self._vertices)] = self._vertices
+            tex_coords[:len(self._tex_coords)] = self._tex_coords
+            self._vertices = vertices
+            self._tex_coords = tex_coords
 
     def _get_text(self):
         return self._text
     def _set_text(self, text):
-        self._text = text
-        h = self.font.height
-        x = 0
-        self.char_sprites = []
-        for i, char in enumerate(text):
-            if not char in self.font.alphabet:
-                x += self.font.space_width
+        old = self._text
+        same = 0
+        limit = min(len(old), len(text))
+        while same < limit and old[same] == text[same]:
+            same += 1
+        if same == len(old) == len(text):
+            return
+
+        if same < len(old):
+            x, quad = self._layout[same]
+        else:
+            x, quad = self._width, self._quad_count
+        del self._layout[same:]
+
+        font = self.font
+        h = font.height
+        widths = font.widths
+        coords = font.coords
+        self._reserve(quad + len(text) - same)
+        vertices = self._vertices
+        tex_coords = self._tex_coords
+        for char in text[same:]:
+            self._layout.append((x, quad))
+            if not char in widths:
+                x += font.space_width
                 continue
-            w = self.font.get_char_width(char)
-            l, t, r, b = self.font.get_char_tex_shape(char)
-            self.char_sprites.append(rabbyt.Sprite(texture=self.texture_id,
-                    shape=(x, 0, x+w, -h),
-                    tex_shape=self.font.get_char_tex_shape(char),
-                    rgba=self.attrgetter('rgba')))
+            w = widths[char]
+            l, t, r, b = coords[char]
+            vertices[quad*8:quad*8+8] = (x, 0, x+w, 0, x+w, -h, x, -h)
+            tex_coords[quad*8:quad*8+8] = (l, t, r, t, r, b, l, b)
+            quad += 1
             x += w+1
+
+        self._text = text
+        self._width = x
+        self._quad_count = quad
     text = property(_get_text, _set_text, doc="the text to be displayed")
 
     def render_after_transform(self):
-        rabbyt.render_unsorted(self.char_sprites)
+        if not self._quad_count:
+            return
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, self.texture_id)
+        glColor4f(*self.rgba)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, self._vertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, self._tex_coords)
+        glDrawArrays(GL_QUADS, 0, self._quad_count*4)
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
@@ -0,0 +1,173 @@
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+
+import numpy
+import pygame
+from pygame import Rect
+
+from blocks import TILE_SIZE
+from collision import TileGrid
+
+CACHE_DIR = os.path.join('cache', 'levels')
+CHUNK_DIR = os.path.join('cache', 'chunks')
+
+# width and height in pixels of the square pieces level art is cut into
+CHUNK_SIZE = 512
+
+# bump whenever the layout of a compiled level file changes
+FORMAT_VERSION = 1
+
+MAGIC = 'NLVL'
+# magic, format version, tile size, width, height, merged rect count
+HEADER = struct.Struct('<4sIIIII')
+
+
+def fileKey(path, settings):
+    """Return a hash of a file's bytes and the settings it is compiled with."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(repr((FORMAT_VERSION, settings)))
+    return digest.hexdigest()
+
+
+def layoutKey(path, colours, tileSize):
+    """Return the cache key of a layout image.
+
+    The key hashes the image file's bytes along with everything else the
+    compiled grid depends on, so editing the image, the colour map or the
+    file format all lead to a fresh compile.
+
+    """
+    return fileKey(path, (tileSize, sorted(colours.items())))
+
+
+def writeGrid(path, grid):
+    """Write a merged TileGrid as a compiled level file.
+
+    The file holds the header, the tile bytes, the per-tile merged rect
+    index and the merged rects, in that order.  It is written to a
+    temporary name and renamed into place so readers never see half a
+    file.
+
+    """
+    rects = numpy.array([(kind,) + tuple(rect) for kind, rect in grid.rects],
+                        numpy.int32).reshape(-1, 5)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, grid.tileSize, grid.width,
+                         grid.height, len(rects))
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    partial = '%s.%d.tmp' % (path, os.getpid())
+    with open(partial, 'wb') as f:
+        f.write(header)
+        f.write(grid.tiles.tostring())
+        f.write(numpy.frombuffer(grid.rectIds, numpy.uintc).astype('<u4')
+                .tostring())
+        f.write(rects.astype('<i4').tostring())
+    os.rename(partial, path)
+
+
+def readGrid(path):
+    """Memory-map a compiled level file and return its TileGrid.
+
+    Raises ValueError if the file is not a complete compiled level of the
+    current format.
+
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if len(mapped) < HEADER.size:
+            raise ValueError('truncated level file %s' % path)
+        magic, version, tileSize, width, height, rectCount = \
+            HEADER.unpack_from(mapped)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('not a version %d level file: %s'
+                             % (FORMAT_VERSION, path))
+        count = width * height
+        if len(mapped) != HEADER.size + count * 5 + rectCount * 20:
+            raise ValueError('truncated level file %s' % path)
+
+        offset = HEADER.size
+        tiles = numpy.frombuffer(mapped, numpy.uint8, count, offset)
+        offset += count
+        rectIds = numpy.frombuffer(mapped, '<u4', count, offset)
+        offset += count * 4
+        rects = numpy.frombuffer(mapped, '<i4', rectCount * 5, offset)
+
+        grid = TileGrid(width, height, tileSize)
+        grid.tiles = array('B', tiles.tostring())
+        grid.rectIds = array('I', rectIds.astype(numpy.uintc).tostring())
+        grid.rects = [(kind, Rect(x, y, w, h)) for kind, x, y, w, h
+                      in rects.reshape(-1, 5).tolist()]
+        return grid
+    finally:
+        mapped.close()
+
+
+def loadLayout(path, colours, loadImage, cacheDir=CACHE_DIR):
+    """Return the merged TileGrid for a layout image, compiling it once.
+
+    A cached grid is loaded without decoding the image at all.  Otherwise
+    the image is read with `loadImage`, parsed, merged and written to the
+    cache for the next start.
+
+    """
+    key = layoutKey(path, colours, TILE_SIZE)
+    cached = os.path.join(cacheDir, key + '.lvl')
+    if os.path.exists(cached):
+        try:
+            return readGrid(cached)
+        except (ValueError, EnvironmentError):
+            pass  # unreadable: compile it again and overwrite it
+
+    grid = TileGrid.fromLayout(loadImage(path), colours)
+    grid.merge()
+    try:
+        writeGrid(cached, grid)
+    except EnvironmentError:
+        pass  # a read-only tree still runs, it just compiles every start
+    return grid
+
+
+def chunkPath(directory, column, row):
+    return os.path.join(directory, '%d_%d.png' % (column, row))
+
+
+def sliceImage(path, chunkSize=CHUNK_SIZE, cacheDir=CHUNK_DIR):
+    """Cut an image into square chunk files once and return where they are.
+
+    Returns `(directory, width, height)`, where chunk `(column, row)` is
+    the file `chunkPath(directory, column, row)` and the chunks on the
+    right and bottom edges may be smaller than `chunkSize`.  The image's
+    size is written last, so a slice that was interrupted is done again.
+
+    """
+    directory = os.path.join(cacheDir, fileKey(path, chunkSize))
+    sizePath = os.path.join(directory, 'size')
+    if os.path.exists(sizePath):
+        with open(sizePath) as f:
+            width, height = map(int, f.read().split())
+        return directory, width, height
+
+    image = pygame.image.load(path)
+    width, height = image.get_size()
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for top in xrange(0, height, chunkSize):
+        for left in xrange(0, width, chunkSize):
+            chunk = image.subsurface(Rect(left, top, chunkSize, chunkSize)
+                                     .clip(image.get_rect()))
+            pygame.image.save(chunk, chunkPath(directory, left // chunkSize,
+                                               top // chunkSize))
+
+    partial = '%s.%d.tmp' % (sizePath, os.getpid())
+    with open(partial, 'w') as f:
+        f.write('%d %d' % (width, height))
+    os.rename(partial, sizePath)
+    return directory, width, height
@@ -0,0 +1,82 @@
+import threading
+
+
+class Background:
+
+    def __init__(self, pos, image, xparallax=0, yparallax=0):
+        self.pos = pos
+        self.image = image
+        self.xparallax = xparallax
+        self.yparallax = yparallax
+
+
+# level name -> (layout image, backgrounds from back to front)
+LEVELS = {
+    'level1': ('assets/level1layout.png',
+               [Background((0, 0), 'assets/background1.png', 15, 15),
+                Background((0, 0), 'assets/level1.png', 1, 1)]),
+    'level2': ('assets/level2layout.png',
+               [Background((0, 0), 'assets/background1.png', 15, 15),
+                Background((0, 0), 'assets/level2.png', 1, 1)]),
+    'level3': ('assets/level3layout.png',
+               [Background((0, 0), 'assets/background3.png', 20, 20),
+                Background((0, 0), 'assets/level3.png', 1, 1)]),
+    'henesys': ('assets/henesyslayout.png',
+                [Background((0, 0), 'assets/background1.png', 15, 15),
+                 Background((0, 0), 'assets/henesys.png', 1, 1)]),
+}
+
+
+class Prefetcher(object):
+
+    """Loads assets on worker threads ahead of the tick that needs them.
+
+    `submit` starts loading under a key and returns at once; `take` hands
+    the result over, waiting only if the load is still running.  A load
+    that failed gives None, so the caller can load it again itself and
+    see the error on its own thread.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> [finished threading.Event, result]
+        self.jobs = {}
+
+    def submit(self, key, load, *args):
+        with self.lock:
+            if key in self.jobs:
+                return
+            job = self.jobs[key] = [threading.Event(), None]
+
+        worker = threading.Thread(target=self.run, args=(job, load, args),
+                                  name='prefetch %s' % key)
+        worker.daemon = True
+        worker.start()
+
+    def run(self, job, load, args):
+        try:
+            job[1] = load(*args)
+        except Exception:
+            pass  # reported when the caller loads it without us
+        finally:
+            job[0].set()
+
+    def ready(self, key):
+        """Return True if a load was submitted under `key` and has finished."""
+        with self.lock:
+            job = self.jobs.get(key)
+        return job is not None and job[0].is_set()
+
+    def discard(self, key):
+        """Forget a load that is no longer needed, finished or not."""
+        with self.lock:
+            self.jobs.pop(key, None)
+
+    def take(self, key):
+        with self.lock:
+            job = self.jobs.pop(key, None)
+        if job is None:
+            return None
+        job[0].wait()
+        return job[1]
@@ -2,63 +2,221 @@
 from __future__ import division
 
 import pygame
-import rabbyt
-import os
 import sys
-import fonts
+import weakref
+import atexit
+
+from timeit import default_timer
 
 from events import *
 from abilities import *
 from buffs import *
+from blocks import *
+from profiling import EventStats, TraceRecorder, traced
+from collision import TileGrid, SweepAndPrune
+from projectiles import ProjectileSystem
+from levelcache import loadLayout
+from levels import LEVELS, Prefetcher
+import profiling
+
+
+class ListenerRegistry:
+
+    """Weakly held set of listeners with deferred membership changes.
+
+    Registrations and removals are collected in pending sets and applied
+    in one batch by `apply`, after which the pending sets are empty
+    again.  Every batch that changes membership bumps `generation` and
+    rebuilds `snapshot`, a tuple of weak references in registration
+    order that can be iterated safely while listeners come and go.
+
+    """
 
-from OpenGL.GL import *
+    def __init__(self):
+        self.listeners = weakref.WeakKeyDictionary()
+        self.pendingAdd = {}
+        self.pendingRemove = set()
+        self.registrationCount = 0
+        self.generation = 0
+        self.snapshot = ()
+
+    def add(self, listener):
+        self.pendingRemove.discard(listener)
+        if listener not in self.listeners and listener not in self.pendingAdd:
+            self.pendingAdd[listener] = self.registrationCount
+            self.registrationCount += 1
+
+    def remove(self, listener):
+        self.pendingAdd.pop(listener, None)
+        if listener in self.listeners:
+            self.pendingRemove.add(listener)
+
+    def apply(self):
+        """Apply pending changes.  Returns True if membership changed."""
+        if not self.pendingAdd and not self.pendingRemove:
+            return False
+        for listener, order in self.pendingAdd.iteritems():
+            self.listeners[listener] = order
+        for listener in self.pendingRemove:
+            self.listeners.pop(listener, None)
+        self.pendingAdd = {}
+        self.pendingRemove = set()
+
+        ordered = sorted(self.listeners.items(), key=lambda item: item[1])
+        self.snapshot = tuple(weakref.ref(listener)
+                              for listener, order in ordered)
+        self.generation += 1
+        return True
 
 
 class EventManager:
 
     def __init__(self):
-        from weakref import WeakKeyDictionary
-        self.listeners = WeakKeyDictionary()
-        self.eventQueue = []
-        self.listenersToAdd = []
-        self.listenersToRemove = []
+        self.registry = ListenerRegistry()
+        # one queue per phase, see events.PHASES
+        self.eventQueues = [[] for phase in PHASES]
+        # coalesceKey -> index of the pending event in its phase's queue
+        self.coalesced = {}
+
+        # event class -> weak references to the listeners to notify, in
+        # registration order.  Built lazily for the current registry
+        # generation.
+        self.dispatchIndex = {}
+        self.indexGeneration = self.registry.generation
+
+        # name -> callable answering synchronous queries; see Query
+        self.services = {}
+
+        # optional profiling.EventStats
+        self.stats = None
 
     def RegisterListener(self, listener):
-        self.listenersToAdd.append(listener)
+        """Queue a listener for registration.
+
+        Listeners that define a `subscriptions` tuple of event classes
+        are only notified of those events; listeners without one receive
+        every event.
+
+        """
+        self.registry.add(listener)
 
     def UnregisterListener(self, listener):
-        self.listenersToRemove.append(listener)
+        self.registry.remove(listener)
 
     def ActuallyUpdateListeners(self):
-        for listener in self.listenersToAdd:
-            self.listeners[listener] = 1
-        for listener in self.listenersToRemove:
-            if listener in self.listeners:
-                del self.listeners[listener]
-
-    def ConsumeEventQueue(self):
+        self.registry.apply()
+
+    def ListenersFor(self, eventType):
+        if self.indexGeneration != self.registry.generation:
+            self.dispatchIndex = {}
+            self.indexGeneration = self.registry.generation
+        targets = self.dispatchIndex.get(eventType)
+        if targets is None:
+            targets = []
+            for ref in self.registry.snapshot:
+                listener = ref()
+                if listener is None:
+                    continue
+                subscriptions = getattr(listener, 'subscriptions', None)
+                if subscriptions is None or eventType in subscriptions:
+                    targets.append(ref)
+            targets = tuple(targets)
+            self.dispatchIndex[eventType] = targets
+        return targets
+
+    def ConsumePhase(self, phase):
+        queue = self.eventQueues[phase]
+        stats = self.stats
+        tracer = profiling.tracer
         i = 0
-        while i < len(self.eventQueue):
-            event = self.eventQueue[i]
-            for listener in self.listeners:
+        while i < len(queue):
+            event = queue[i]
+            if event.coalesces:
+                del self.coalesced[event.coalesceKey()]
+            if tracer is not None:
+                eventStart = default_timer()
+            for ref in self.ListenersFor(event.__class__):
+                listener = ref()
+                if listener is None:
+                    continue
                 # Note: a side effect of notifying the listener
                 # could be that more events are put on the queue
                 # or listeners could Register / Unregister
-                old = len(self.eventQueue)
-                listener.Notify(event)
+                if stats is None:
+                    listener.Notify(event)
+                else:
+                    start = default_timer()
+                    listener.Notify(event)
+                    stats.notified(listener, default_timer() - start)
+            if tracer is not None:
+                tracer.complete(event.name, 'event', eventStart,
+                                default_timer())
             i += 1
-            if self.listenersToAdd:
-                self.ActuallyUpdateListeners()
+            self.ActuallyUpdateListeners()
         # all code paths that could possibly add more events to
-        # the eventQueue have been exhausted at this point, so
-        # it's safe to empty the queue
-        self.eventQueue = []
+        # this queue have been exhausted at this point, so
+        # it's safe to empty it and recycle pooled events
+        for event in queue:
+            if event.pooled:
+                event.release()
+        self.eventQueues[phase] = []
+
+    def ConsumeEventQueue(self):
+        """Dispatch queued events phase by phase until all queues are empty.
+
+        A phase is drained completely, including events posted to it while
+        it runs, before the next one starts.  Events posted to an earlier
+        phase in the meantime are picked up before moving on.
+
+        """
+        queues = self.eventQueues
+        phase = 0
+        while phase < len(queues):
+            if queues[phase]:
+                self.ConsumePhase(phase)
+                phase = 0
+            else:
+                phase += 1
+
+    def RegisterService(self, name, handler):
+        self.services[name] = handler
+
+    def UnregisterService(self, name):
+        self.services.pop(name, None)
+
+    def Query(self, name, *args):
+        """Ask the service registered under `name` and return its answer.
+
+        Queries run immediately instead of going through the event queue,
+        for round trips where the caller needs the result straight away
+        (e.g. what a character collides with).  The caller only depends on
+        the service name, not on the object providing it.
+
+        """
+        return self.services[name](*args)
 
     def Post(self, event):
-        self.eventQueue.append(event)
-        if event.name == 'TickEvent':
+        if self.stats is not None:
+            self.stats.posted(event)
+        queue = self.eventQueues[event.phaseIndex]
+        if event.coalesces:
+            key = event.coalesceKey()
+            index = self.coalesced.get(key)
+            if index is not None:
+                replaced = queue[index]
+                queue[index] = event
+                if replaced.pooled:
+                    replaced.release()
+                return
+            self.coalesced[key] = len(queue)
+        queue.append(event)
+        if self.stats is not None:
+            self.stats.queued(sum(len(q) for q in self.eventQueues))
+        if event.flush:
             self.ActuallyUpdateListeners()
             self.ConsumeEventQueue()
+            if self.stats is not None and event.typeCode == TickEvent.typeCode:
+                self.stats.endTick()
 
 
 def endProgram():
@@ -67,14 +225,12 @@ def endProgram():
 
 
 class GameController:
+    subscriptions = (PlayerJoinEvent, GamePausedEvent, GameRunningEvent)
 
     def __init__(self, evManager, playerName=None):
         self.evManager = evManager
         self.evManager.RegisterListener(self)
 
-        self.drawCounter = 0
-        self.drawCountTo = 1
-
         self.activePlayer = None
         self.playerName = playerName
         self.players = []
@@ -85,12 +241,12 @@ class GameController:
 
         if key[pygame.K_LEFT]:
             direction = 'left'
-            event = CharacterWalkRequest(direction)
+            event = CharacterWalkRequest.acquire(direction)
             self.evManager.Post(event)
 
         elif key[pygame.K_RIGHT]:
             direction = 'right'
-            event = CharacterWalkRequest(direction)
+            event = CharacterWalkRequest.acquire(direction)
             self.evManager.Post(event)
 
         for e in pygame.event.get():
@@ -122,6 +278,8 @@ class GameController:
                     ev = AbilityUseEvent('ThrowKnifeAbility')
                 elif e.key == pygame.K_v:
                     ev = AbilityUseEvent('PounceAbility')
+                elif e.key == pygame.K_F12:
+                    ev = TraceDumpRequest()
 
             if ev:
                 self.evManager.Post(ev)
@@ -140,14 +298,7 @@ class GameController:
                 self.evManager.Post(ev)
 
     def Notify(self, event):
-        if event.name == 'TickEvent':
-            self.drawCounter += 1
-            if self.drawCounter == self.drawCountTo:
-                self.drawCounter = 0
-
-                event = DrawEvent()
-                self.evManager.Post(event)
-        elif event.name == 'PlayerJoinEvent':
+        if event.name == 'PlayerJoinEvent':
             self.players.append(event.player)
             if event.player.name == self.playerName:
                 self.activePlayer = event.player
@@ -161,6 +312,7 @@ class GameController:
 
 
 class TickController:
+    subscriptions = ()
 
     def __init__(self, evManager):
         self.evManager = evManager
@@ -168,247 +320,80 @@ class TickController:
 
         self.running = 1
         self.clock = pygame.time.Clock()
-        self.fps = 60
+        self.tickRate = 60  # simulation steps per second
+        self.maxFrameTime = 0.25  # most real time simulated per frame
+        self.fps = 0  # frame rate cap, 0 leaves it to vsync
         self.showFps = False
 
     def run(self):
+        step = 1 / self.tickRate
+        accumulator = 0.0
+        previous = default_timer()
         while self.running:
             self.clock.tick(self.fps)
-            event = TickEvent()
-
-            if self.showFps:
-                event = TickEvent(self.clock.get_fps())
-
-            self.evManager.Post(event)
-
-    def Notify(self, event):
-        pass
-
-
-class Sprite(rabbyt.Sprite):
+            start = default_timer()
+            accumulator += min(start - previous, self.maxFrameTime)
+            previous = start
 
-    def __init__(self, *args, **kwargs):
-        rabbyt.Sprite.__init__(self, *args, **kwargs)
+            # the simulation always advances in fixed steps, catching up
+            # after slow frames; rendering happens once per frame and
+            # interpolates between the last two steps
+            while accumulator >= step:
+                self.evManager.Post(TickEvent.acquire())
+                accumulator -= step
 
-        glBindTexture(GL_TEXTURE_2D, self.texture_id)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
-        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
-
-
-class CharacterSprite:
-
-    def __init__(self):
-
-        self.idleRight = [((0, 64, 32, 0), (0, 1, 1 / 8, 3 / 4))]
-        self.idleLeft = [((0, 64, 32, 0), (1 / 8, 1, 0, 3 / 4))]
-
-        self.walkRight = [((0, 64, 48, 0), (0, 3 / 4, 3 / 16, 1 / 2)),
-                          ((0, 64, 48, 0), (3 / 16, 3 / 4, 6 / 16, 1 / 2)),
-                          ((0, 64, 48, 0), (6 / 16, 3 / 4, 9 / 16, 1 / 2)),
-                          ((0, 64, 48, 0), (9 / 16, 3 / 4, 12 / 16, 1 / 2)),
-                          ((0, 64, 48, 0), (12 / 16, 3 / 4, 15 / 16, 1 / 2))]
-
-        self.walkLeft = [((0, 64, 48, 0), (3 / 16, 3 / 4, 0, 1 / 2)),
-                         ((0, 64, 48, 0), (6 / 16, 3 / 4, 3 / 16, 1 / 2)),
-                         ((0, 64, 48, 0), (9 / 16, 3 / 4, 6 / 16, 1 / 2)),
-                         ((0, 64, 48, 0), (12 / 16, 3 / 4, 9 / 16, 1 / 2)),
-                         ((0, 64, 48, 0), (15 / 16, 3 / 4, 12 / 16, 1 / 2))]
-
-        self.jumpRight = [((0, 64, 48, 0), (0, 1 / 2, 3 / 16, 1 / 4))]
-        self.jumpLeft = [((0, 64, 48, 0), (3 / 16, 1 / 2, 0, 1 / 4))]
-
-        self.punchRight = [((0, 64, 48, 0), (0, 1 / 4, 3 / 16, 0))]
-        self.punchLeft = [((0, 64, 48, 0), (3 / 16, 1 / 4, 0, 0))]
-
-        self.dashRight = [((0, 64, 48, 0), (196 / 256, 1, 1, 208 / 256))]
-        self.dashLeft = [((0, 64, 48, 0), (1, 1, 196 / 256, 208 / 256))]
-
-        self.onwallRight = [((0, 64, 48, 0), (3 / 16, 1 / 2, 0, 1 / 4))]
-        self.onwallLeft = [((0, 64, 48, 0), (0, 1 / 2, 3 / 16, 1 / 4))]
-
-        self.name = 'CharacterSprite'
-
-        self.image = Sprite('assets/ninja.png')
-        self.image.shape = (0, 0, 0, 0)
-
-    def set_cell(self, frame, action):
-        if action == 'idleRight':
-            shapes = self.idleRight[frame]
-        elif action == 'idleLeft':
-            shapes = self.idleLeft[frame]
-        elif action == 'walkRight':
-            shapes = self.walkRight[frame]
-        elif action == 'walkLeft':
-            shapes = self.walkLeft[frame]
-        elif action == 'jumpRight':
-            shapes = self.jumpRight[frame]
-        elif action == 'jumpLeft':
-            shapes = self.jumpLeft[frame]
-        elif action == 'punchRight':
-            shapes = self.punchRight[frame]
-        elif action == 'punchLeft':
-            shapes = self.punchLeft[frame]
-        elif action == 'dashRight':
-            shapes = self.dashRight[frame]
-        elif action == 'dashLeft':
-            shapes = self.dashLeft[frame]
-        elif action == 'onwallLeft':
-            shapes = self.onwallLeft[frame]
-        elif action == 'onwallRight':
-            shapes = self.onwallRight[frame]
-
-        self.image.shape, self.image.tex_shape = shapes
-
-
-class View:
+            if self.showFps:
+                fps = self.clock.get_fps()
+            else:
+                fps = 0
+            self.evManager.Post(DrawEvent.acquire(accumulator / step, fps))
 
-    def __init__(self, evManager):
-        self.evManager = evManager
-        self.evManager.RegisterListener(self)
+            if profiling.tracer is not None:
+                profiling.tracer.complete('frame', 'tick', start,
+                                          default_timer())
 
-        self.camera = Camera(evManager)
+    def runSteps(self, count):
+        """Run `count` simulation steps back to back, as fast as possible.
 
-        self.windowSize = 1280, 720
+        Nothing is drawn and there is no frame cap.  Returns the number of
+        steps per second achieved.
 
-        if pygame.display.Info().current_h > 768:
-            os.environ['SDL_VIDEO_CENTERED'] = '1'
-        else:
-            offset_left = int(
-                (pygame.display.Info().current_w - self.windowSize[0]) / 2)
-            window_pos = str(offset_left) + ',' + '6'
-            os.environ['SDL_VIDEO_WINDOW_POS'] = window_pos
-
-        self.window = rabbyt.init_display(self.windowSize)
-
-        self.sprites = []
-
-    def addSprite(self, sprite):
-        self.sprites.append(sprite())
-
-    def getCharacter(self):
-        for s in self.sprites:
-            if s.name == 'CharacterSprite':
-                return s
-
-    def moveSprite(self, sprite, pos):
-        window_y = self.windowSize[1] / 2
-        window_x = self.windowSize[0] / 2
-        halfSpriteHeight = sprite.shape[1][1] / 2
-        halfSpriteWidth = sprite.shape[1][0] / 2
-        camera = self.camera.rect
-
-        top = window_y + camera.top - pos[1] + halfSpriteHeight
-        left = window_x + camera.left - pos[0] + halfSpriteWidth
-        sprite.top, sprite.left = top, -left
-
-    def moveBackground(self, sprite, pos, xparallax, yparallax):
-        window_y = self.windowSize[1] / 2
-        window_x = self.windowSize[0] / 2
-        camera = self.camera.rect
-
-        top = window_y - pos[1]
-        left = window_x - pos[0]
-        if xparallax:
-            left += camera.left / xparallax
-        if yparallax:
-            top += camera.top / yparallax
-        sprite.top, sprite.left = top, -left
-
-    def killCharacterSprite(self):
-        character = self.getCharacter()
-        if character:
-            self.sprites.remove(character)
-
-    def buildLevel(self, backgrounds):
-        for b in backgrounds:
-            background = BackgroundSprite(
-                b.pos, b.image, b.xparallax, b.yparallax)
-            self.sprites.append(background)
+        """
+        start = default_timer()
+        for i in xrange(count):
+            self.evManager.Post(TickEvent.acquire())
+        return count / (default_timer() - start)
 
     def Notify(self, event):
-        if event.name == 'DrawEvent':
-            pass
-
-        elif event.name == 'TickEvent':
-            rect = self.camera.rect
-            for i in self.sprites:
-                sprite = i.image
-                if i.name == 'BackgroundSprite':
-                    self.moveBackground(
-                        sprite, (0, 0), i.xparallax, i.yparallax)
-                sprite.render()
-
-            if event.fps:
-
-                fps = int(event.fps)
-                string = str(fps)
-                pgFont = pygame.font.Font(None, 20)
-                rabbytFont = fonts.Font(pgFont)
-                fontSprite = fonts.FontSprite(rabbytFont, string)
-                fontSprite.render()
-            pygame.display.flip()
-
-        elif event.name == 'SpriteAddEvent':
-            self.sprites.append(event.sprite)
-
-        elif event.name == 'SpritemodelAddEvent':
-            self.sprites.append(event.model.sprite)
-
-        elif event.name == 'ProjectileUpdateEvent':
-            projectile = event.projectile
-            for sprite in self.sprites:
-                if projectile.sprite == sprite:
-                    if projectile.isAlive:
-                        self.moveSprite(sprite.image, projectile.rect.center)
-                    else:
-                        self.sprites.remove(sprite)
-
-        elif event.name == 'SpriteKillEvent':
-            for i in self.sprites:
-                if event.model.sprite == i:
-                    self.sprites.remove(i)
-
-        elif event.name == 'CharacterAddEvent':
-            self.addSprite(CharacterSprite)
-
-        elif event.name == 'CharacterKillEvent':
-            self.killCharacterSprite()
-
-        elif event.name == 'CharacterUpdateEvent':
-            character = self.getCharacter()
-            self.moveSprite(character.image, event.rect.center)
-
-        elif event.name == 'CharacterSetImage':
-            character = self.getCharacter()
-            character.set_cell(event.frame, event.action)
-
-        elif event.name == 'LevelBuildEvent':
-            backgrounds = event.backgrounds
-            self.buildLevel(backgrounds)
-            if event.layout.get_width() * 8 < self.windowSize[0]:
-                self.camera.xscroll = False
-            if event.layout.get_height() * 8 < self.windowSize[1]:
-                self.camera.yscroll = False
+        pass
 
 
 class Game:
     STATE_RUNNING = 'running'
     STATE_PAUSED = 'paused'
 
-    def __init__(self, evManager):
+    subscriptions = (TickEvent, GameUpdateEvent, PlayerJoinRequest,
+                     CharacterAddEvent, LevelBuildEvent, GameStartEvent,
+                     GamePauseEvent)
+
+    def __init__(self, evManager, levelName='level1'):
         self.evManager = evManager
         self.evManager.RegisterListener(self)
 
         self.state = Game.STATE_PAUSED
 
+        self.levelName = levelName
         self.level = Level(evManager)
         self.players = []
+        # characters; projectiles live in the level's ProjectileSystem and
+        # the level itself is a TileGrid
         self.entities = []
+        self.broadPhase = SweepAndPrune()
 
     def start(self):
         self.state = Game.STATE_RUNNING
 
-        self.level.build()
+        self.level.build(self.levelName)
 
     def add_player(self, player):
         self.players.append(player)
@@ -426,26 +411,33 @@ class Game:
     def getEntities(self):
         characters = [
             player.character for player in self.players if player.character]
-        blocks = self.level.blocks
-        projectiles = [projectile for projectile in self.level.projectiles]
 
-        self.entities = characters + blocks + projectiles
+        self.entities = characters
 
+    @traced('Game.update')
     def update(self):
         for player in self.players:
             player.update()
         self.level.update()
 
+        # candidate pairs stay in broadPhase.pairs until they get a consumer
+        self.broadPhase.update(self.entities, self.level.projectiles)
+
     def Notify(self, event):
         if event.name == 'TickEvent':
             if self.state == Game.STATE_PAUSED:
-                event = GamePausedEvent()
+                event = GamePausedEvent.acquire()
 
             elif self.state == Game.STATE_RUNNING:
-                self.update()
-                event = GameRunningEvent()
+                # input is gathered in response to GameRunningEvent, and
+                # the update runs in the simulation phase after it
+                self.evManager.Post(GameUpdateEvent.acquire())
+                event = GameRunningEvent.acquire()
             self.evManager.Post(event)
 
+        elif event.name == 'GameUpdateEvent':
+            self.update()
+
         elif event.name == 'PlayerJoinRequest':
             player = Player(self.evManager)
             player.set_data(event.playerData)
@@ -455,12 +447,6 @@ class Game:
             self.getEntities()
         elif event.name == 'LevelBuildEvent':
             self.getEntities()
-        elif event.name == 'ProjectileAddEvent':
-            self.getEntities()
-
-        elif event.name == 'CharacterCollideRequest':
-            event = CharacterCollideEvent(event.direction, self.entities)
-            self.evManager.Post(event)
 
         elif event.name == 'GameStartEvent':
             self.start()
@@ -470,182 +456,73 @@ class Game:
             self.pause()
 
 
-class Camera:
-
-    def __init__(self, evManager):
-        self.evManager = evManager
-        self.evManager.RegisterListener(self)
-
-        self.rect = pygame.Rect(0, 0, 1280, 720)
-        self.maxOffset = 100
-        self.xbound = self.ybound = 0
-        self.xscroll = self.yscroll = True
-
-    def centerOn(self, pos):
-
-        rect = self.rect
-        if self.yscroll:
-            ydist = rect.centery - pos[1]
-
-            if ydist == 1 or ydist == -1:
-                ydist = 0
-            if ydist < 0:
-                rect.centery += 2
-
-                if ydist < -10:
-                    rect.centery += 2
-                if ydist < -20:
-                    rect.centery += 4
-                if ydist < -self.maxOffset:
-                    rect.centery = pos[1] - self.maxOffset
-
-            elif ydist > 0:
-                rect.centery -= 2
-
-                if ydist > 10:
-                    rect.centery -= 2
-                if ydist > 20:
-                    rect.centery -= 5
-                if ydist > self.maxOffset:
-                    rect.centery = pos[1] + self.maxOffset
-            if rect.top < 0:
-                rect.top = 0
-            elif rect.bottom > self.ybound:
-                rect.bottom = self.ybound
-        if self.xscroll:
-            rect.centerx = pos[0]
-
-            if rect.left < 0:
-                rect.left = 0
-            elif rect.right > self.xbound:
-                rect.right = self.xbound
-
-        event = CameraMoveEvent(self.rect.topleft)
-        self.evManager.Post(event)
-
-    def Notify(self, event):
-        if event.name == 'CameraCenterRequest':
-            self.centerOn(event.pos)
-        elif event.name == 'LevelBuildEvent':
-            self.xbound = event.layout.get_width() * 8
-            self.ybound = event.layout.get_height() * 8
-
-
 class Level:
+    subscriptions = (LevelBuildRequest, LevelPrefetchRequest,
+                     ProjectileAddEvent)
 
     def __init__(self, evManager):
         self.evManager = evManager
         self.evManager.RegisterListener(self)
 
-        self.projectiles = []
-
-    def build(self):
-        layout = load_image('assets/level1layout.png')
-        level = Background((0, 0), 'assets/level1.png', 1, 1)
-        background = Background((0, 0), 'assets/background1.png', 15, 15)
-        #layout = load_image('henesyslayout.png')
-        #level = Background((0,0), 'henesys.png', 1,1)
-        #layout = load_image('citylevellayout.png')
-        #level = Background((0,0), 'citylevel.png',1, 1)
-        #layout = load_image('level3layout.png')
-        #level = Background((0, 0), 'level3.png', 1, 1)
-        #background = Background((0, 0), 'background3.png', 20, 20)
-
-        self.backgrounds = [background, level]
-
-        width, height = layout.get_size()
-
-        self.blocks = []
-        from blocks import Block, Platform, Step
-
-        for y in xrange(height):
-            for x in xrange(width):
-                pos = x * 8, y * 8
-
-                if layout.get_at((x, y)) == (0, 0, 0, 255):
-                    self.blocks.append(Block(pos))
-
-                elif layout.get_at((x, y)) == (0, 0, 255, 255):
-                    self.blocks.append(Platform(pos))
-
-                elif layout.get_at((x, y)) == (255, 0, 0, 255):
-                    self.blocks.append(Step(pos))
+        self.name = None
+        self.projectiles = ProjectileSystem()
+        self.tiles = TileGrid(0, 0)
+        self.prefetcher = Prefetcher()
+
+        self.evManager.RegisterService('LevelTiles', self.getTiles)
+
+    def getTiles(self):
+        return self.tiles
+
+    def prefetch(self, name):
+        """Start compiling a level's layout on a worker thread."""
+        layout, backgrounds = LEVELS[name]
+        self.prefetcher.submit(layout, loadLayout, layout, LAYOUT_COLOURS,
+                               pygame.image.load)
+
+    def build(self, name):
+        layout, backgrounds = LEVELS[name]
+        self.name = name
+        self.backgrounds = backgrounds
+
+        # compiled once per layout image and loaded from the cache after
+        tiles = self.prefetcher.take(layout)
+        if tiles is None:
+            tiles = loadLayout(layout, LAYOUT_COLOURS, load_image)
+        self.tiles = tiles
+
+        # knives don't carry over into another level
+        if self.projectiles.count:
+            self.projectiles.clear()
+            event = ProjectileUpdateEvent.acquire(self.projectiles)
+            self.evManager.Post(event)
 
-        event = LevelBuildEvent(layout, self.backgrounds)
+        event = LevelBuildEvent(self.tiles, self.backgrounds)
         self.evManager.Post(event)
 
+    @traced('Level.update')
     def update(self):
-        for p in self.projectiles:
-            p.update()
-            for b in self.blocks:
-                if b.name == 'Block' or b.name == 'Step':
-                    if p.rect.colliderect(b.rect):
-                        p.response()
-                        break
-            if not p.isAlive:
-                self.projectiles.remove(p)
-            event = ProjectileUpdateEvent(p)
+        self.projectiles.update(self.tiles)
+        if self.projectiles.count or self.projectiles.killed:
+            event = ProjectileUpdateEvent.acquire(self.projectiles)
             self.evManager.Post(event)
 
     def Notify(self, event):
         if event.name == 'LevelBuildRequest':
-            self.build(event.layout, event.backgrounds)
+            self.build(event.level)
+
+        elif event.name == 'LevelPrefetchRequest':
+            self.prefetch(event.level)
 
         elif event.name == 'ProjectileAddEvent':
-            self.projectiles.append(event.projectile)
+            self.projectiles.add(event.projectile)
 
             event = SpritemodelAddEvent(event.projectile, event.projectile.pos)
             self.evManager.Post(event)
 
 
-class Background:
-
-    def __init__(self, pos, image, xparallax=0, yparallax=0):
-        self.pos = pos
-        self.image = image
-        self.xparallax = xparallax
-        self.yparallax = yparallax
-
-
-class BackgroundSprite:
-
-    def __init__(self, pos, image, xparallax=0, yparallax=0):
-        self.name = 'BackgroundSprite'
-
-        self.xparallax = xparallax
-        self.yparallax = yparallax
-        self.image = Sprite(image)
-
-
-class ButtonCooldownSprite:
-
-    def __init__(self, pos, image, decreaseby):
-        self.name = 'ButtonCooldownSprite'
-        self.image = Sprite(image)
-        self.pos = pos
-        self.image.top, self.image.left = pos[0] - 32, pos[1] - 32
-        self.image.shape = (0, 0, 0, 0)
-        self.height = 64
-        self.decreaseby = decreaseby
-
-    def update(self):
-        self.height -= self.decreaseby
-        self.image.shape = (0, self.height, 64, 0)
-        self.image.tex_shape = (0, self.height / 64, 1, 0)
-
-
-class SkillButtonSprite:
-
-    def __init__(self, pos, image, shape=None):
-        self.name = 'SkillButtonSprite'
-        self.pos = pos
-        self.image = Sprite(image)
-        self.image.top, self.image.left = pos
-        if shape:
-            self.image.shape = shape
-
-
 class Player:
+    subscriptions = (CharacterAddRequest, AbilityUseEvent)
 
     def __init__(self, evManager):
         self.evManager = evManager
@@ -667,25 +544,9 @@ class Player:
         if name == 'Ninja':
             self.abilities = [
                 ThrowKnifeAbility(), DashAbility(), PounceAbility()]
-            self.buttons = [SkillButtonSprite((-250, -600), 'assets/button_throwknife.png'),
-                            SkillButtonSprite(
-                                (-250, -520), 'assets/button_dash.png'),
-                            SkillButtonSprite((-250, -440), 'assets/button_dash.png')]
-
-            self.cooldownbuttons = [
-              ButtonCooldownSprite(self.buttons[0].pos, 'assets/button_throwknifecd.png',
-                                   64 / self.abilities[0].maxcooldown),
-              ButtonCooldownSprite(self.buttons[1].pos, 'assets/button_dashcd.png',
-                                   64 / self.abilities[1].maxcooldown),
-              ButtonCooldownSprite(self.buttons[2].pos, 'assets/button_dashcd.png',
-                                   64 / self.abilities[2].maxcooldown)]
-
-            for i in self.buttons:
-                event = SpriteAddEvent(i, i.pos)
-                self.evManager.Post(event)
-            for i in self.cooldownbuttons:
-                event = SpriteAddEvent(i, i.pos)
-                self.evManager.Post(event)
+
+            event = AbilitiesAddEvent(self.abilities)
+            self.evManager.Post(event)
 
             self.character = Ninja(self.evManager, pos)
 
@@ -694,13 +555,12 @@ class Player:
 
     def update(self):
         if self.character:
-            for i in self.abilities:
-                if i.cooldown > 0:
-                    i.cooldown -= 1
-                    button = self.cooldownbuttons[self.abilities.index(i)]
-                    button.update()
-                    if i.cooldown == 0:
-                        button.height = 64
+            for index, ability in enumerate(self.abilities):
+                if ability.cooldown > 0:
+                    ability.cooldown -= 1
+                    remaining = ability.cooldown / ability.maxcooldown
+                    event = AbilityCooldownEvent.acquire(index, remaining)
+                    self.evManager.Post(event)
             self.character.update()
 
     def ninjaAbilities(self, abilityname):
@@ -741,6 +601,9 @@ class Character:
     STATE_DASHING = 'dashing'
     STATE_POUNCING = 'pouncing'
 
+    subscriptions = (BuffAddEvent, CharacterWalkRequest, CharacterJumpRequest,
+                     CharacterDropEvent)
+
     def __init__(self, evManager, pos):
         self.evManager = evManager
         self.evManager.RegisterListener(self)
@@ -770,6 +633,8 @@ class Character:
 
         self.dx = 0
         self.dy = 0
+        # set for one tick to fall through platforms
+        self.dropping = False
 
         self.walk_frame = 0
         self.walk_animFrame = 0
@@ -796,16 +661,18 @@ class Character:
 
     def whenIdle(self):
         if self.facing == 'right':
-            event = CharacterSetImage(0, 'idleRight')
+            event = CharacterSetImage.acquire(self, 0, 'idleRight')
         else:
-            event = CharacterSetImage(0, 'idleLeft')
+            event = CharacterSetImage.acquire(self, 0, 'idleLeft')
         self.evManager.Post(event)
 
     def whenWalking(self):
         if self.facing == 'right':
-            event = CharacterSetImage(self.walk_animFrame, 'walkRight')
+            event = CharacterSetImage.acquire(
+                self, self.walk_animFrame, 'walkRight')
         else:
-            event = CharacterSetImage(self.walk_animFrame, 'walkLeft')
+            event = CharacterSetImage.acquire(
+                self, self.walk_animFrame, 'walkLeft')
         self.evManager.Post(event)
 
         if self.walk_frame % 5 == 0:
@@ -850,9 +717,9 @@ class Character:
             self.walk_animFrame = -1
         if self.state == 'jumping':
             if self.facing == 'right':
-                event = CharacterSetImage(0, 'jumpRight')
+                event = CharacterSetImage.acquire(self, 0, 'jumpRight')
             else:
-                event = CharacterSetImage(0, 'jumpLeft')
+                event = CharacterSetImage.acquire(self, 0, 'jumpLeft')
             self.evManager.Post(event)
 
         if self.state == 'punching' or self.punch_frame:
@@ -869,10 +736,10 @@ class Character:
 
         self.rect.topleft = self.pos
 
-        event = CameraCenterRequest(self.rect.center)
+        event = CameraCenterRequest.acquire(self.rect.center)
         self.evManager.Post(event)
 
-        event = CharacterUpdateEvent(self.rect)
+        event = CharacterUpdateEvent.acquire(self.rect)
         self.evManager.Post(event)
 
     def updateMovement(self):
@@ -888,23 +755,11 @@ class Character:
         if self.dy > 15.0:
             self.dy = 15.0
 
-        if self.dy < 0.0:
-            event = CharacterCollideRequest('up')
-            self.evManager.Post(event)
-        else:
-            event = CharacterCollideRequest('down')
-            self.evManager.Post(event)
-
-        if self.dx < 0.0:
-            event = CharacterCollideRequest('left')
-            self.evManager.Post(event)
-        else:
-            event = CharacterCollideRequest('right')
-            self.evManager.Post(event)
-
         if self.pos[0] < 0:
             self.pos = 0, self.pos[1]
 
+        self.move()
+
     def jump(self):
         if not self.inAir and self.state != 'jumping':
             self.state = Character.STATE_JUMPING
@@ -958,39 +813,35 @@ class Character:
 
         self.dy += self.gravity
 
-    def checkCollideX(self, direction, entities):
-        self.pos = self.pos[0] + self.dx, self.pos[1]
-
+    @traced('Character.move')
+    def move(self):
+        """Move by (dx, dy) against the level and react to the contacts."""
         rect = self.rect
-        rect.topleft = self.pos
-
-        colliderect = rect.colliderect
-        collided = [e for e in entities if colliderect(e.rect)]
-
-        collidedBlocks = []
-        collidedSteps = []
+        tiles = self.evManager.Query('LevelTiles')
+        x, y, normalX, normalY = tiles.sweep(
+            self.pos[0], self.pos[1], rect.width, rect.height,
+            self.dx, self.dy, not self.dropping)
+        self.dropping = False
 
-        for c in collided:
-            if c.name == 'Block':
-                collidedBlocks.append(c.rect)
-            elif c.name == 'Step':
-                collidedSteps.append(c.rect)
-
-        collideLeft = collideRight = False
-        if collidedBlocks:
-            collideRect = collidedBlocks[0]
-            for ix in xrange(len(collidedBlocks)):
-                collideRect = collideRect.union(collidedBlocks[ix])
-
-            if direction == 'left':
-                self.pos = collideRect.right, self.pos[1]
-                collideLeft = True
+        self.pos = x, y
+        rect.topleft = self.pos
 
-            elif direction == 'right':
-                self.pos = collideRect.left - rect.width, self.pos[1]
-                collideRight = True
+        if normalY < 0:
+            self.state = Character.STATE_IDLE
+            self.inAir = False
+            self.gravity = 0
+            self.pounce_frame = 0
+        else:
+            if normalY > 0:
+                if self.state == 'jumping':
+                    self.jumpFallVel = self.jumpForce
+                if self.state == 'pouncing':
+                    self.gravity += 1.5
+                    self.state = Character.STATE_IDLE
+            if self.state != 'jumping':
+                self.inAir = True
 
-        if collideLeft or collideRight:
+        if normalX:
             self.speed = 0
             if self.state == 'dashing' or self.dash_frame:
                 self.state = Character.STATE_IDLE
@@ -1011,93 +862,6 @@ class Character:
 
         self.dx = self.dy = 0
 
-    def checkCollideY(self, direction, entities):
-        self.pos = self.pos[0], self.pos[1] + self.dy
-
-        rect = self.rect
-        rect.topleft = self.pos
-
-        if self.dy < 8:
-            footheight = self.dy
-        else:
-            footheight = 9
-        footrect = pygame.Rect(
-            rect.left, rect.bottom - footheight - 1, rect.width, footheight)
-
-        colliderect = rect.colliderect
-        collided = [e for e in entities if colliderect(e.rect)]
-
-        collidedBlocks = []
-        collidedPlatforms = []
-        collidedSteps = []
-
-        for c in collided:
-            if c.name == 'Block':
-                collidedBlocks.append(c.rect)
-            elif c.name == 'Platform':
-                if footrect.colliderect(c.rect):
-                    collidedPlatforms.append(c.rect)
-            elif c.name == 'Step':
-                collidedSteps.append(c.rect)
-
-        collideUp = collideDown = False
-        if collidedBlocks:
-            collideRect = collidedBlocks[0]
-            for ix in xrange(len(collidedBlocks)):
-                collideRect = collideRect.union(collidedBlocks[ix])
-
-            if direction == 'up':
-                self.pos = self.pos[0], collideRect.bottom
-                if self.state == 'jumping':
-                    self.jumpFallVel = self.jumpForce
-
-                collideUp = True
-
-            elif direction == 'down':
-                self.pos = self.pos[0], collideRect.top - rect.height
-                self.state = Character.STATE_IDLE
-                self.inAir = False
-                self.gravity = 0
-
-                collideDown = True
-        if collidedPlatforms and direction == 'down':
-            heights = [platform.top for platform in collidedPlatforms]
-            index = heights.index(min(heights))
-
-            collideRect = collidedPlatforms[index]
-
-            self.pos = self.pos[0], collideRect.bottom - rect.height
-            self.state = Character.STATE_IDLE
-            self.inAir = False
-            self.gravity = 0
-
-            collideDown = True
-
-        if collidedSteps and direction == 'down':
-            heights = [step.top for step in collidedSteps]
-            index = heights.index(min(heights))
-
-            collideRect = collidedSteps[index]
-
-            self.pos = self.pos[0], collideRect.bottom - rect.height
-            self.state = Character.STATE_IDLE
-            self.inAir = False
-            self.gravity = 0
-
-            collideDown = True
-
-        if collideUp:
-            if self.state == 'pouncing':
-                self.gravity += 1.5
-                self.state = Character.STATE_IDLE
-
-        if collideDown:
-            self.pounce_frame = 0
-            self.state = Character.STATE_IDLE
-        else:
-            if self.state != 'jumping':
-                self.inAir = True
-
     def Notify(self, event):
         if not self.isAlive:  # if dead, stop listening for events here
             return
@@ -1110,20 +874,16 @@ class Character:
             elif event.direction == 'right':
                 self.walk('right')
 
-        elif event.name == 'CharacterCollideEvent':
-            if event.direction == 'left' or event.direction == 'right':
-                self.checkCollideX(event.direction, event.entities)
-            else:
-                self.checkCollideY(event.direction, event.entities)
-
         elif event.name == 'CharacterJumpRequest':
             self.jump()
         elif event.name == 'CharacterDropEvent':
             if self.state == 'idle' or self.state == 'walking':
                 self.dy = 9
+                self.dropping = True
 
 
 class Ninja(Character):
+    subscriptions = Character.subscriptions + (CharacterPunchRequest,)
 
     def __init__(self, evManager, pos):
         Character.__init__(self, evManager, pos)
@@ -1151,9 +911,9 @@ class Ninja(Character):
     def whenOnWall(self):
         self.state = Character.STATE_ONWALL
         if self.facing == 'right':
-            event = CharacterSetImage(0, 'onwallRight')
+            event = CharacterSetImage.acquire(self, 0, 'onwallRight')
         else:
-            event = CharacterSetImage(0, 'onwallLeft')
+            event = CharacterSetImage.acquire(self, 0, 'onwallLeft')
         self.evManager.Post(event)
 
     def jump(self):
@@ -1177,9 +937,9 @@ class Ninja(Character):
         self.punch_frame += 1
 
         if self.facing == 'right':
-            event = CharacterSetImage(0, 'punchRight')
+            event = CharacterSetImage.acquire(self, 0, 'punchRight')
         else:
-            event = CharacterSetImage(0, 'punchLeft')
+            event = CharacterSetImage.acquire(self, 0, 'punchLeft')
         self.evManager.Post(event)
 
         if self.punch_frame > 6:
@@ -1200,9 +960,9 @@ class Ninja(Character):
         self.dash_frame += 1
 
         if self.facing == 'right':
-            event = CharacterSetImage(0, 'dashRight')
+            event = CharacterSetImage.acquire(self, 0, 'dashRight')
         else:
-            event = CharacterSetImage(0, 'dashLeft')
+            event = CharacterSetImage.acquire(self, 0, 'dashLeft')
         self.evManager.Post(event)
 
         if self.dash_frame > 10:
@@ -1215,9 +975,9 @@ class Ninja(Character):
 
         PounceAbility().update(self, self.facing)
         if self.facing == 'right':
-            event = CharacterSetImage(0, 'dashRight')
+            event = CharacterSetImage.acquire(self, 0, 'dashRight')
         else:
-            event = CharacterSetImage(0, 'dashLeft')
+            event = CharacterSetImage.acquire(self, 0, 'dashLeft')
         self.evManager.Post(event)
         if self.pounce_frame > 100:
             self.pounce_frame = 0
@@ -1251,6 +1011,8 @@ class Ninja(Character):
 
 class ThrowKnife:
 
+    # spawn parameters only: once added to a level, the knife is simulated
+    # by the level's ProjectileSystem
     def __init__(self, pos, direction):
         self.name = 'ThrowKnife'
 
@@ -1265,65 +1027,70 @@ class ThrowKnife:
         else:
             self.dx = -16
 
-        self.sprite = ThrowKnifeSprite()
         self.isAlive = 30
 
         self.dy = -0.6
         self.gravity = 0.08
 
-    def update(self):
-        self.pos = self.pos[0] + self.dx, self.pos[1] + self.dy
-        self.dy += self.gravity
-        self.rect.topleft = self.pos
-
-        self.sprite.update(self.dx)
-
-        self.isAlive -= 1
-
-        if self.isAlive < 3:
-            self.sprite.image.alpha -= 0.2
-
-    def response(self):
-        self.isAlive = 0
-
-
-class ThrowKnifeSprite:
-
-    def __init__(self):
-        self.name = 'ThrowKnifeSprite'
-        self.frames = [((0, 6, 16, 0), (0, 1, 1, 5 / 8)),
-                       ((0, 4, 16, 0), (0, 3 / 4, 1, 0))]
-        self.leftFrames = [((0, 6, 16, 0), (1, 1, 0, 5 / 8)),
-                           ((0, 4, 16, 0), (1, 3 / 4, 0, 0))]
-        self.image = Sprite('assets/throwknife.png')
-        self.image.shape = (0, 0, 0, 0)
-
-        self.frame = 0
-
-    def update(self, direction):
-        frame = self.frame
-        if direction > 0:
-            shapes = self.frames[frame]
-        else:
-            shapes = self.leftFrames[frame]
-
-        self.image.shape, self.image.tex_shape = shapes
-
 
 def load_image(filename, xflip=0, yflip=0):
-    image = pygame.image.load(filename).convert_alpha()
+    image = pygame.image.load(filename)
+    if pygame.display.get_surface():
+        # converting needs a display; headless runs use the image as loaded
+        image = image.convert_alpha()
     image = pygame.transform.flip(image, xflip, yflip)
     return image
 
 
+def runHeadless(evManager, tickController, ticks, players):
+    """Simulate `ticks` steps with no display, GL context or frame cap."""
+    evManager.Post(GameStartEvent())
+    for i in xrange(players):
+        evManager.Post(PlayerJoinRequest({'name': 'player%d' % i}))
+    evManager.Post(CharacterAddRequest((600, 32)))
+
+    rate = tickController.runSteps(ticks)
+    print '%d ticks, %.0f ticks/s' % (ticks, rate)
+
+
 def main():
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stats', action='store_true',
+                        help='record event statistics to eventstats.json')
+    parser.add_argument('--trace', action='store_true',
+                        help='record a trace timeline, written on F12')
+    parser.add_argument('--headless', action='store_true',
+                        help='run the simulation only, without a window')
+    parser.add_argument('--ticks', type=int, default=10000,
+                        help='number of ticks to simulate when headless')
+    parser.add_argument('--players', type=int, default=1,
+                        help='number of players to spawn when headless')
+    parser.add_argument('--level', default='level1', choices=sorted(LEVELS),
+                        help='level to start in')
+    args = parser.parse_args()
+
     pygame.init()
 
     evManager = EventManager()
+    if args.stats:
+        evManager.stats = EventStats()
+        atexit.register(evManager.stats.dump, 'eventstats.json')
+    if args.trace:
+        # press F12 to write the buffered timeline
+        tracer = TraceRecorder(evManager)
+        tracer.install()
     tickController = TickController(evManager)
+    if args.headless:
+        game = Game(evManager, args.level)
+        runHeadless(evManager, tickController, args.ticks, args.players)
+        return
+
+    # the view needs rabbyt and an OpenGL context, so only load it here
+    from view import View
     gameController = GameController(evManager)
     view = View(evManager)
-    game = Game(evManager)
+    game = Game(evManager, args.level)
     tickController.run()
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+import json
+from collections import Counter, defaultdict, deque
+from timeit import default_timer
+
+from events import TraceDumpRequest
+
+
+class EventStats(object):
+
+    """Opt-in per-tick instrumentation for an EventManager.
+
+    Attach an instance as `evManager.stats` to record, for every tick, how
+    many events of each type were posted, the peak number of queued
+    events and the wall time spent in each listener class's `Notify`.
+    The last `history` ticks are kept along with running totals.
+
+    """
+
+    def __init__(self, history=600):
+        self.ticks = 0
+        self.history = deque(maxlen=history)
+
+        self.totalPosted = Counter()
+        self.totalNotifyCalls = Counter()
+        self.totalNotifyTime = defaultdict(float)
+        self.peakQueue = 0
+
+        self.startTick()
+
+    def startTick(self):
+        self.tickPosted = Counter()
+        self.tickNotifyTime = defaultdict(float)
+        self.tickPeakQueue = 0
+
+    def posted(self, event):
+        self.tickPosted[event.name] += 1
+
+    def queued(self, depth):
+        if depth > self.tickPeakQueue:
+            self.tickPeakQueue = depth
+
+    def notified(self, listener, seconds):
+        name = listener.__class__.__name__
+        self.tickNotifyTime[name] += seconds
+        self.totalNotifyCalls[name] += 1
+
+    def endTick(self):
+        record = {
+            'tick': self.ticks,
+            'posted': dict(self.tickPosted),
+            'peakQueue': self.tickPeakQueue,
+            'notifyTime': dict(self.tickNotifyTime),
+        }
+        self.history.append(record)
+
+        self.totalPosted.update(self.tickPosted)
+        for name, seconds in self.tickNotifyTime.iteritems():
+            self.totalNotifyTime[name] += seconds
+        self.peakQueue = max(self.peakQueue, self.tickPeakQueue)
+        self.ticks += 1
+        self.startTick()
+
+    def lastTick(self):
+        """Return the record of the most recently finished tick, or None."""
+        if self.history:
+            return self.history[-1]
+
+    def slowestListeners(self, count=5):
+        """Return `(class name, seconds)` pairs, most expensive first."""
+        ranked = sorted(self.totalNotifyTime.items(),
+                        key=lambda item: item[1], reverse=True)
+        return ranked[:count]
+
+    def summary(self):
+        ticks = self.ticks or 1
+        listeners = {}
+        for name, seconds in self.totalNotifyTime.iteritems():
+            listeners[name] = {
+                'calls': self.totalNotifyCalls[name],
+                'seconds': seconds,
+                'msPerTick': seconds * 1000 / ticks,
+            }
+        return {
+            'ticks': self.ticks,
+            'posted': dict(self.totalPosted),
+            'peakQueue': self.peakQueue,
+            'listeners': listeners,
+        }
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump({'summary': self.summary(),
+                       'ticks': list(self.history)}, f, indent=2)
+
+
+tracer = None  # the active TraceRecorder, if any; see TraceRecorder.install
+
+
+def traced(name):
+    """Decorator recording every call of a function as a trace span.
+
+    When no TraceRecorder is installed the wrapper only adds a global
+    lookup to the call.
+
+    """
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return func(*args, **kwargs)
+            start = default_timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.complete(name, 'call', start, default_timer())
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorate
+
+
+class TraceRecorder(object):
+
+    """Ring buffer of timed spans, exported as Chrome trace-event JSON.
+
+    Spans are stored as plain tuples and the oldest ones are dropped once
+    `capacity` is reached, so recording can stay on for a whole session.
+    Posting a TraceDumpRequest writes the buffered timeline to a file that
+    chrome://tracing (or any trace-event viewer) can open.
+
+    """
+    subscriptions = (TraceDumpRequest,)
+
+    def __init__(self, evManager, capacity=100000, prefix='trace'):
+        self.evManager = evManager
+        self.evManager.RegisterListener(self)
+
+        self.spans = deque(maxlen=capacity)
+        self.prefix = prefix
+        self.origin = default_timer()
+        self.dumps = 0
+
+    def install(self):
+        global tracer
+        tracer = self
+
+    def uninstall(self):
+        global tracer
+        if tracer is self:
+            tracer = None
+
+    def complete(self, name, category, start, end):
+        self.spans.append((name, category, start, end))
+
+    def traceEvents(self):
+        origin = self.origin
+        events = []
+        for name, category, start, end in self.spans:
+            events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': 0,
+                'tid': 0,
+            })
+        return events
+
+    def dump(self, path=None):
+        if path is None:
+            path = '%s-%d.json' % (self.prefix, self.dumps)
+        self.dumps += 1
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.traceEvents(),
+                       'displayTimeUnit': 'ms'}, f)
+        return path
+
+    def Notify(self, event):
+        if event.name == 'TraceDumpRequest':
+            print 'trace written to', self.dump()
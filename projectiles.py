@@ -0,0 +1,123 @@
+import numpy
+
+from blocks import BLOCK, STEP
+
+# tile kinds that stop a projectile
+SOLID_TILES = (BLOCK, STEP)
+
+
+class ProjectileSystem(object):
+
+    """Every live projectile of a level, stored as parallel NumPy arrays.
+
+    Slot `i` of `pos`, `vel`, `gravity`, `life` and `size` describes the
+    projectile spawned from `models[i]`; only the first `count` slots are
+    in use.  `update` integrates all of them and tests them against the
+    level's TileGrid in a handful of array operations, then packs the
+    survivors to the front.  The models that died are left in `killed`
+    until the next update so the view can drop their sprites.
+
+    """
+
+    def __init__(self, capacity=64):
+        self.count = 0
+        self.pos = numpy.zeros((capacity, 2))
+        self.vel = numpy.zeros((capacity, 2))
+        self.gravity = numpy.zeros(capacity)
+        self.life = numpy.zeros(capacity, numpy.int32)
+        self.size = numpy.zeros((capacity, 2), numpy.int32)
+
+        self.models = []
+        self.killed = []
+
+        self.solid = numpy.zeros(256, bool)
+        self.solid[list(SOLID_TILES)] = True
+
+    def __len__(self):
+        return self.count
+
+    def grow(self):
+        for name in ('pos', 'vel', 'gravity', 'life', 'size'):
+            old = getattr(self, name)
+            setattr(self, name, numpy.concatenate((old,
+                                                   numpy.zeros_like(old))))
+
+    def add(self, model):
+        """Spawn a projectile from a model's position, motion and lifetime."""
+        if self.count == len(self.life):
+            self.grow()
+        index = self.count
+        self.pos[index] = model.pos
+        self.vel[index] = model.dx, model.dy
+        self.gravity[index] = model.gravity
+        self.life[index] = model.isAlive
+        self.size[index] = model.rect.size
+        self.models.append(model)
+        self.count += 1
+
+    def clear(self):
+        """Kill every projectile; the models are left in `killed`."""
+        self.killed = self.models
+        self.models = []
+        self.count = 0
+
+    def rects(self):
+        """Return the integer left, top, right and bottom of every slot."""
+        count = self.count
+        # truncated toward zero, as pygame.Rect does with a float position
+        left = self.pos[:count, 0].astype(int)
+        top = self.pos[:count, 1].astype(int)
+        return (left, top, left + self.size[:count, 0],
+                top + self.size[:count, 1])
+
+    def hitTiles(self, tiles):
+        """Return a mask of the projectiles overlapping a solid tile."""
+        hit = numpy.zeros(self.count, bool)
+        if not tiles.width or not tiles.height:
+            return hit
+        grid = numpy.frombuffer(tiles.tiles, numpy.uint8)
+        grid = grid.reshape(tiles.height, tiles.width)
+
+        size = tiles.tileSize
+        left, top, right, bottom = self.rects()
+        firstColumn, lastColumn = left // size, (right - 1) // size
+        firstRow, lastRow = top // size, (bottom - 1) // size
+
+        # a projectile covers only a few tiles, so walk those offsets for
+        # every projectile at once
+        for across in xrange((lastColumn - firstColumn).max() + 1):
+            column = firstColumn + across
+            inColumn = ((column <= lastColumn) & (column >= 0) &
+                        (column < tiles.width))
+            column = column.clip(0, tiles.width - 1)
+            for down in xrange((lastRow - firstRow).max() + 1):
+                row = firstRow + down
+                inside = (inColumn & (row <= lastRow) & (row >= 0) &
+                          (row < tiles.height))
+                row = row.clip(0, tiles.height - 1)
+                hit |= inside & self.solid[grid[row, column]]
+        return hit
+
+    def update(self, tiles):
+        count = self.count
+        if not count:
+            self.killed = []
+            return
+
+        self.pos[:count] += self.vel[:count]
+        self.vel[:count, 1] += self.gravity[:count]
+        life = self.life[:count]
+        life -= 1
+        life[self.hitTiles(tiles)] = 0
+
+        alive = life > 0
+        models = self.models
+        self.killed = [models[index]
+                       for index in numpy.flatnonzero(~alive)]
+        if self.killed:
+            keep = numpy.flatnonzero(alive)
+            for array in (self.pos, self.vel, self.gravity, self.life,
+                          self.size):
+                array[:len(keep)] = array[keep]
+            self.models = [models[index] for index in keep]
+            self.count = len(keep)
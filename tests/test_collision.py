@@ -0,0 +1,67 @@
+import random
+import unittest
+
+from pygame import Rect
+
+from collision import SweepAndPrune
+from projectiles import ProjectileSystem
+
+
+class Box(object):
+
+    def __init__(self, rect):
+        self.rect = rect
+
+
+class Knife(object):
+
+    def __init__(self, pos, size):
+        self.pos = pos
+        self.rect = Rect(pos, size)
+        self.dx = self.dy = self.gravity = 0
+        self.isAlive = 30
+
+
+class SweepAndPruneTest(unittest.TestCase):
+
+    def bruteForce(self, characters, knives):
+        pairs = set()
+        for index, character in enumerate(characters):
+            for other in characters[index + 1:] + knives:
+                if character.rect.colliderect(other.rect):
+                    pairs.add(frozenset((id(character), id(other))))
+        return pairs
+
+    def testMatchesBruteForce(self):
+        generator = random.Random(16)
+        for attempt in xrange(200):
+            characters = [Box(Rect(generator.randint(-50, 400),
+                                   generator.randint(-50, 400),
+                                   generator.randint(1, 64),
+                                   generator.randint(1, 64)))
+                          for i in xrange(generator.randint(0, 8))]
+            # fractional and negative positions exercise the truncation
+            knives = [Knife((generator.uniform(-60, 400),
+                             generator.uniform(-60, 400)),
+                            (generator.randint(1, 24),
+                             generator.randint(1, 24)))
+                      for i in xrange(generator.randint(0, 60))]
+            projectiles = ProjectileSystem(capacity=4)
+            for knife in knives:
+                projectiles.add(knife)
+
+            pairs = SweepAndPrune().update(characters, projectiles)
+            found = [frozenset((id(a), id(b))) for a, b in pairs]
+            self.assertEqual(len(found), len(set(found)))
+            self.assertEqual(set(found),
+                             self.bruteForce(characters, knives))
+
+    def testKnivesAreNeverPaired(self):
+        projectiles = ProjectileSystem()
+        for i in xrange(3):
+            projectiles.add(Knife((0, 0), (16, 6)))
+        self.assertEqual(SweepAndPrune().update([], projectiles), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,638 @@
+from __future__ import division
+
+import os
+from collections import OrderedDict
+
+import pygame
+import rabbyt
+import fonts
+
+from batch import SpriteBatch
+from events import *
+from levelcache import CHUNK_SIZE, chunkPath, sliceImage
+from levels import LEVELS, Prefetcher
+from profiling import traced
+
+from OpenGL.GL import *
+
+# bytes of background chunk textures kept loaded before the least recently
+# drawn ones are deleted
+CHUNK_BUDGET = 64 * 1024 * 1024
+
+# how far outside the screen, in pixels, a world sprite is still drawn
+CULL_MARGIN = 64
+
+
+def decodeImage(filename):
+    """Return an image file's RGBA bytes and size, ready for load_texture."""
+    image = pygame.image.load(filename)
+    return pygame.image.tostring(image, 'RGBA', True), image.get_size()
+
+
+class Sprite(rabbyt.Sprite):
+
+    def __init__(self, *args, **kwargs):
+        rabbyt.Sprite.__init__(self, *args, **kwargs)
+
+        glBindTexture(GL_TEXTURE_2D, self.texture_id)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+
+
+class CharacterSprite:
+
+    def __init__(self):
+
+        self.idleRight = [((0, 64, 32, 0), (0, 1, 1 / 8, 3 / 4))]
+        self.idleLeft = [((0, 64, 32, 0), (1 / 8, 1, 0, 3 / 4))]
+
+        self.walkRight = [((0, 64, 48, 0), (0, 3 / 4, 3 / 16, 1 / 2)),
+                          ((0, 64, 48, 0), (3 / 16, 3 / 4, 6 / 16, 1 / 2)),
+                          ((0, 64, 48, 0), (6 / 16, 3 / 4, 9 / 16, 1 / 2)),
+                          ((0, 64, 48, 0), (9 / 16, 3 / 4, 12 / 16, 1 / 2)),
+                          ((0, 64, 48, 0), (12 / 16, 3 / 4, 15 / 16, 1 / 2))]
+
+        self.walkLeft = [((0, 64, 48, 0), (3 / 16, 3 / 4, 0, 1 / 2)),
+                         ((0, 64, 48, 0), (6 / 16, 3 / 4, 3 / 16, 1 / 2)),
+                         ((0, 64, 48, 0), (9 / 16, 3 / 4, 6 / 16, 1 / 2)),
+                         ((0, 64, 48, 0), (12 / 16, 3 / 4, 9 / 16, 1 / 2)),
+                         ((0, 64, 48, 0), (15 / 16, 3 / 4, 12 / 16, 1 / 2))]
+
+        self.jumpRight = [((0, 64, 48, 0), (0, 1 / 2, 3 / 16, 1 / 4))]
+        self.jumpLeft = [((0, 64, 48, 0), (3 / 16, 1 / 2, 0, 1 / 4))]
+
+        self.punchRight = [((0, 64, 48, 0), (0, 1 / 4, 3 / 16, 0))]
+        self.punchLeft = [((0, 64, 48, 0), (3 / 16, 1 / 4, 0, 0))]
+
+        self.dashRight = [((0, 64, 48, 0), (196 / 256, 1, 1, 208 / 256))]
+        self.dashLeft = [((0, 64, 48, 0), (1, 1, 196 / 256, 208 / 256))]
+
+        self.onwallRight = [((0, 64, 48, 0), (3 / 16, 1 / 2, 0, 1 / 4))]
+        self.onwallLeft = [((0, 64, 48, 0), (0, 1 / 2, 3 / 16, 1 / 4))]
+
+        self.name = 'CharacterSprite'
+
+        self.image = Sprite('assets/ninja.png')
+        self.image.shape = (0, 0, 0, 0)
+
+    def set_cell(self, frame, action):
+        if action == 'idleRight':
+            shapes = self.idleRight[frame]
+        elif action == 'idleLeft':
+            shapes = self.idleLeft[frame]
+        elif action == 'walkRight':
+            shapes = self.walkRight[frame]
+        elif action == 'walkLeft':
+            shapes = self.walkLeft[frame]
+        elif action == 'jumpRight':
+            shapes = self.jumpRight[frame]
+        elif action == 'jumpLeft':
+            shapes = self.jumpLeft[frame]
+        elif action == 'punchRight':
+            shapes = self.punchRight[frame]
+        elif action == 'punchLeft':
+            shapes = self.punchLeft[frame]
+        elif action == 'dashRight':
+            shapes = self.dashRight[frame]
+        elif action == 'dashLeft':
+            shapes = self.dashLeft[frame]
+        elif action == 'onwallLeft':
+            shapes = self.onwallLeft[frame]
+        elif action == 'onwallRight':
+            shapes = self.onwallRight[frame]
+
+        self.image.shape, self.image.tex_shape = shapes
+
+
+class ThrowKnifeSprite:
+
+    def __init__(self):
+        self.name = 'ThrowKnifeSprite'
+        self.frames = [((0, 6, 16, 0), (0, 1, 1, 5 / 8)),
+                       ((0, 4, 16, 0), (0, 3 / 4, 1, 0))]
+        self.leftFrames = [((0, 6, 16, 0), (1, 1, 0, 5 / 8)),
+                           ((0, 4, 16, 0), (1, 3 / 4, 0, 0))]
+        self.image = Sprite('assets/throwknife.png')
+        self.image.shape = (0, 0, 0, 0)
+
+        self.frame = 0
+
+    def update(self, direction):
+        frame = self.frame
+        if direction > 0:
+            shapes = self.frames[frame]
+        else:
+            shapes = self.leftFrames[frame]
+
+        self.image.shape, self.image.tex_shape = shapes
+
+
+class BackgroundSprite:
+
+    """A background layer drawn from the chunk files of its image.
+
+    Which chunks are loaded is up to the view's ChunkCache; the layer only
+    knows where its chunks are and how far it scrolls with the camera.
+
+    """
+
+    def __init__(self, directory, width, height, xparallax=0, yparallax=0,
+                 chunkSize=CHUNK_SIZE):
+        self.name = 'BackgroundSprite'
+
+        self.directory = directory
+        self.width = width
+        self.height = height
+        self.chunkSize = chunkSize
+        self.xparallax = xparallax
+        self.yparallax = yparallax
+        # chunk files being decoded for this layer
+        self.pending = set()
+
+    def chunkRange(self, camera, windowSize, margin):
+        """Return `(column, row)` of the chunks in view, plus `margin`."""
+        left, top = camera
+        left = left / self.xparallax if self.xparallax else 0
+        top = top / self.yparallax if self.yparallax else 0
+        size = self.chunkSize
+
+        firstColumn = max(int(left // size) - margin, 0)
+        lastColumn = min(int((left + windowSize[0] - 1) // size) + margin,
+                         (self.width - 1) // size)
+        firstRow = max(int(top // size) - margin, 0)
+        lastRow = min(int((top + windowSize[1] - 1) // size) + margin,
+                      (self.height - 1) // size)
+        return [(column, row) for row in xrange(firstRow, lastRow + 1)
+                for column in xrange(firstColumn, lastColumn + 1)]
+
+
+class ChunkCache:
+
+    """Keeps the background chunks around the camera as textures.
+
+    Chunks within `margin` chunks of the screen are decoded on worker
+    threads and uploaded once they are ready; a chunk that is on screen
+    but still loading is waited for.  Uploaded chunks are kept in least
+    recently drawn order and the oldest are deleted whenever the textures
+    add up to more than `budget` bytes, so neither video memory nor the
+    decoded pixels grow with the size of the level.
+
+    """
+
+    def __init__(self, prefetcher, budget=CHUNK_BUDGET, margin=1):
+        self.prefetcher = prefetcher
+        self.budget = budget
+        self.margin = margin
+
+        # chunk file -> [sprite, texture id, bytes, frame last drawn], least
+        # recently drawn first
+        self.chunks = OrderedDict()
+        self.used = 0
+        self.frame = 0
+
+    def upload(self, path, decoded):
+        if decoded is None:
+            decoded = decodeImage(path)
+        data, (width, height) = decoded
+        texture = rabbyt.load_texture(data, (width, height))
+        sprite = Sprite(texture=texture, shape=(0, height, width, 0))
+        self.chunks[path] = [sprite, texture, width * height * 4, self.frame]
+        self.used += width * height * 4
+
+    def forget(self, layer):
+        """Stop decoding the chunks of a layer that is going away."""
+        for path in layer.pending:
+            self.prefetcher.discard(path)
+        layer.pending.clear()
+
+    def render(self, layer, camera, windowSize, place):
+        directory = layer.directory
+        wanted = set(chunkPath(directory, column, row) for column, row
+                     in layer.chunkRange(camera, windowSize, self.margin))
+        for path in layer.pending - wanted:
+            self.prefetcher.discard(path)
+        layer.pending &= wanted
+
+        for path in wanted:
+            if path not in self.chunks and path not in layer.pending:
+                self.prefetcher.submit(path, decodeImage, path)
+                layer.pending.add(path)
+        for path in list(layer.pending):
+            if self.prefetcher.ready(path):
+                self.upload(path, self.prefetcher.take(path))
+                layer.pending.discard(path)
+
+        size = layer.chunkSize
+        for column, row in layer.chunkRange(camera, windowSize, 0):
+            path = chunkPath(directory, column, row)
+            if path not in self.chunks:
+                # on screen already, so it can't wait for a later frame
+                self.upload(path, self.prefetcher.take(path))
+                layer.pending.discard(path)
+            # move it to the most recently drawn end
+            chunk = self.chunks.pop(path)
+            self.chunks[path] = chunk
+            chunk[3] = self.frame
+
+            place(chunk[0], (column * size, row * size), layer.xparallax,
+                  layer.yparallax, camera)
+            chunk[0].render()
+
+    def evict(self):
+        """Delete the least recently drawn chunks until under budget."""
+        while self.used > self.budget:
+            path, chunk = next(self.chunks.iteritems())
+            if chunk[3] == self.frame:
+                break  # everything left is on screen
+            del self.chunks[path]
+            glDeleteTextures([chunk[1]])
+            self.used -= chunk[2]
+        self.frame += 1
+
+
+class ButtonCooldownSprite:
+
+    def __init__(self, pos, image):
+        self.name = 'ButtonCooldownSprite'
+        self.image = Sprite(image)
+        self.pos = pos
+        self.image.top, self.image.left = pos[0] - 32, pos[1] - 32
+        self.image.shape = (0, 0, 0, 0)
+        self.height = 64
+
+    def update(self, remaining):
+        self.height = 64 * remaining
+        self.image.shape = (0, self.height, 64, 0)
+        self.image.tex_shape = (0, self.height / 64, 1, 0)
+
+
+class SkillButtonSprite:
+
+    def __init__(self, pos, image, shape=None):
+        self.name = 'SkillButtonSprite'
+        self.pos = pos
+        self.image = Sprite(image)
+        self.image.top, self.image.left = pos
+        if shape:
+            self.image.shape = shape
+
+
+class HudText:
+
+    """A line of HUD text that is laid out again only when it changes."""
+
+    def __init__(self, font, pos=(0, 0)):
+        self.name = 'HudText'
+        self.value = None
+        self.sprite = fonts.FontSprite(font, '')
+        self.sprite.xy = pos
+
+    def render(self, value):
+        if value != self.value:
+            self.value = value
+            self.sprite.text = str(value)
+        self.sprite.render()
+
+
+class View:
+    subscriptions = (TickEvent, DrawEvent, SpriteAddEvent,
+                     SpritemodelAddEvent, ProjectileUpdateEvent,
+                     SpriteKillEvent, CharacterAddEvent, CharacterKillEvent,
+                     CharacterUpdateEvent, CharacterSetImage, LevelBuildEvent,
+                     LevelPrefetchRequest, AbilitiesAddEvent,
+                     AbilityCooldownEvent)
+
+    # sprite class for each kind of model announced by SpritemodelAddEvent
+    modelSprites = {'ThrowKnife': ThrowKnifeSprite}
+
+    # button and cooldown overlay images for each ability
+    abilityButtons = {
+        'ThrowKnifeAbility': ('assets/button_throwknife.png',
+                              'assets/button_throwknifecd.png'),
+        'DashAbility': ('assets/button_dash.png', 'assets/button_dashcd.png'),
+        'PounceAbility': ('assets/button_dash.png',
+                          'assets/button_dashcd.png'),
+    }
+
+    def __init__(self, evManager):
+        self.evManager = evManager
+        self.evManager.RegisterListener(self)
+
+        self.camera = Camera(evManager)
+
+        self.windowSize = 1280, 720
+
+        if pygame.display.Info().current_h > 768:
+            os.environ['SDL_VIDEO_CENTERED'] = '1'
+        else:
+            offset_left = int(
+                (pygame.display.Info().current_w - self.windowSize[0]) / 2)
+            window_pos = str(offset_left) + ',' + '6'
+            os.environ['SDL_VIDEO_WINDOW_POS'] = window_pos
+
+        self.window = rabbyt.init_display(self.windowSize)
+
+        # level art is sliced and decoded on worker threads, but GL calls
+        # have to stay on this thread
+        self.prefetcher = Prefetcher()
+        self.chunks = ChunkCache(self.prefetcher)
+        self.batch = SpriteBatch()
+        self.fpsText = HudText(fonts.get_font(None, 20))
+
+        self.sprites = []
+        # id(model) -> sprite, for models added with SpritemodelAddEvent
+        self.models = {}
+        self.buttons = []
+        self.cooldownButtons = []
+
+        # id(sprite image) -> [image, previous, current] world position of
+        # its center over the last two simulation steps
+        self.positions = {}
+
+    def addSprite(self, sprite):
+        self.sprites.append(sprite())
+
+    def getCharacter(self):
+        for s in self.sprites:
+            if s.name == 'CharacterSprite':
+                return s
+
+    def moveSprite(self, sprite, pos, camera):
+        window_y = self.windowSize[1] / 2
+        window_x = self.windowSize[0] / 2
+        halfSpriteHeight = sprite.shape[1][1] / 2
+        halfSpriteWidth = sprite.shape[1][0] / 2
+        cameraLeft, cameraTop = camera
+
+        top = window_y + cameraTop - pos[1] + halfSpriteHeight
+        left = window_x + cameraLeft - pos[0] + halfSpriteWidth
+        sprite.top, sprite.left = top, -left
+
+    def moveBackground(self, sprite, pos, xparallax, yparallax, camera):
+        window_y = self.windowSize[1] / 2
+        window_x = self.windowSize[0] / 2
+        cameraLeft, cameraTop = camera
+
+        top = window_y - pos[1]
+        left = window_x - pos[0]
+        if xparallax:
+            left += cameraLeft / xparallax
+        if yparallax:
+            top += cameraTop / yparallax
+        sprite.top, sprite.left = top, -left
+
+    def trackSprite(self, sprite, pos):
+        position = self.positions.get(id(sprite))
+        if position is None:
+            self.positions[id(sprite)] = [sprite, pos, pos]
+        else:
+            position[2] = pos
+
+    def untrackSprite(self, sprite):
+        self.positions.pop(id(sprite), None)
+
+    def placeSprites(self, alpha, camera):
+        """Move the tracked sprites near the screen; return the rest.
+
+        A tracked sprite's world bounds are its interpolated center plus
+        half its shape.  Sprites whose bounds miss the screen grown by
+        CULL_MARGIN are not moved, and the ids of their images are
+        returned so render can skip them too.
+
+        """
+        left, top = camera
+        left -= CULL_MARGIN
+        top -= CULL_MARGIN
+        right = left + self.windowSize[0] + 2 * CULL_MARGIN
+        bottom = top + self.windowSize[1] + 2 * CULL_MARGIN
+
+        culled = set()
+        for key, (sprite, previous, current) in self.positions.iteritems():
+            x = previous[0] + (current[0] - previous[0]) * alpha
+            y = previous[1] + (current[1] - previous[1]) * alpha
+            halfWidth, halfHeight = sprite.shape[1]
+            halfWidth, halfHeight = abs(halfWidth) / 2, abs(halfHeight) / 2
+            if (x + halfWidth < left or x - halfWidth > right or
+                    y + halfHeight < top or y - halfHeight > bottom):
+                culled.add(key)
+            else:
+                self.moveSprite(sprite, (x, y), camera)
+        return culled
+
+    def addModelSprite(self, model):
+        sprite = self.modelSprites[model.name]()
+        self.models[id(model)] = sprite
+        self.sprites.append(sprite)
+
+    def killModelSprite(self, model):
+        sprite = self.models.pop(id(model), None)
+        if sprite:
+            self.sprites.remove(sprite)
+            self.untrackSprite(sprite.image)
+
+    def updateProjectiles(self, projectiles):
+        for model in projectiles.killed:
+            self.killModelSprite(model)
+
+        left, top, right, bottom = projectiles.rects()
+        for index, model in enumerate(projectiles.models):
+            sprite = self.models.get(id(model))
+            if not sprite:
+                continue
+            sprite.update(projectiles.vel[index, 0])
+            if projectiles.life[index] < 3:
+                sprite.image.alpha -= 0.2
+            center = ((left[index] + right[index]) // 2,
+                      (top[index] + bottom[index]) // 2)
+            self.trackSprite(sprite.image, center)
+
+    def addAbilityButtons(self, abilities):
+        for sprite in self.buttons + self.cooldownButtons:
+            self.sprites.remove(sprite)
+        self.buttons = []
+        self.cooldownButtons = []
+        for index, ability in enumerate(abilities):
+            image, cooldownImage = self.abilityButtons[ability.name]
+            pos = -250, -600 + 80 * index
+            self.buttons.append(SkillButtonSprite(pos, image))
+            self.cooldownButtons.append(ButtonCooldownSprite(pos,
+                                                             cooldownImage))
+        self.sprites.extend(self.buttons)
+        self.sprites.extend(self.cooldownButtons)
+
+    def killCharacterSprite(self):
+        character = self.getCharacter()
+        if character:
+            self.sprites.remove(character)
+            self.untrackSprite(character.image)
+
+    def prefetchLevel(self, name):
+        """Start slicing a level's background images on worker threads."""
+        layout, backgrounds = LEVELS[name]
+        for b in backgrounds:
+            self.prefetcher.submit(b.image, sliceImage, b.image)
+
+    def buildLevel(self, backgrounds):
+        # drop the previous level's backgrounds, the new ones go at the
+        # back of the draw order
+        sprites = []
+        for sprite in self.sprites:
+            if sprite.name == 'BackgroundSprite':
+                self.chunks.forget(sprite)
+            else:
+                sprites.append(sprite)
+
+        layers = []
+        for b in backgrounds:
+            sliced = self.prefetcher.take(b.image)
+            if sliced is None:
+                sliced = sliceImage(b.image)
+            directory, width, height = sliced
+            layers.append(BackgroundSprite(directory, width, height,
+                                           b.xparallax, b.yparallax))
+        self.sprites = layers + sprites
+
+    @traced('View.render')
+    def render(self, alpha, fps):
+        camera = self.camera.interpolate(alpha)
+        culled = self.placeSprites(alpha, camera)
+
+        for i in self.sprites:
+            if i.name == 'BackgroundSprite':
+                self.chunks.render(i, camera, self.windowSize,
+                                   self.moveBackground)
+            elif id(i.image) not in culled:
+                self.batch.add(i.image)
+        self.chunks.evict()
+        self.batch.draw()
+
+        if fps:
+            self.fpsText.render(int(fps))
+
+    @traced('pygame.display.flip')
+    def flip(self):
+        pygame.display.flip()
+
+    def Notify(self, event):
+        if event.name == 'TickEvent':
+            for position in self.positions.itervalues():
+                position[1] = position[2]
+
+        elif event.name == 'DrawEvent':
+            self.render(event.alpha, event.fps)
+            self.flip()
+
+        elif event.name == 'SpriteAddEvent':
+            self.sprites.append(event.sprite)
+
+        elif event.name == 'SpritemodelAddEvent':
+            self.addModelSprite(event.model)
+
+        elif event.name == 'ProjectileUpdateEvent':
+            self.updateProjectiles(event.projectiles)
+
+        elif event.name == 'SpriteKillEvent':
+            self.killModelSprite(event.model)
+
+        elif event.name == 'AbilitiesAddEvent':
+            self.addAbilityButtons(event.abilities)
+
+        elif event.name == 'AbilityCooldownEvent':
+            self.cooldownButtons[event.index].update(event.remaining)
+
+        elif event.name == 'CharacterAddEvent':
+            self.addSprite(CharacterSprite)
+
+        elif event.name == 'CharacterKillEvent':
+            self.killCharacterSprite()
+
+        elif event.name == 'CharacterUpdateEvent':
+            character = self.getCharacter()
+            self.trackSprite(character.image, event.rect.center)
+
+        elif event.name == 'CharacterSetImage':
+            character = self.getCharacter()
+            character.set_cell(event.frame, event.action)
+
+        elif event.name == 'LevelBuildEvent':
+            backgrounds = event.backgrounds
+            self.buildLevel(backgrounds)
+            tiles = event.tiles
+            self.camera.xscroll = (tiles.width * tiles.tileSize >=
+                                   self.windowSize[0])
+            self.camera.yscroll = (tiles.height * tiles.tileSize >=
+                                   self.windowSize[1])
+
+        elif event.name == 'LevelPrefetchRequest':
+            self.prefetchLevel(event.level)
+
+
+class Camera:
+    subscriptions = (TickEvent, CameraCenterRequest, LevelBuildEvent)
+
+    def __init__(self, evManager):
+        self.evManager = evManager
+        self.evManager.RegisterListener(self)
+
+        self.rect = pygame.Rect(0, 0, 1280, 720)
+        self.previous = self.rect.topleft
+        self.maxOffset = 100
+        self.xbound = self.ybound = 0
+        self.xscroll = self.yscroll = True
+
+    def centerOn(self, pos):
+
+        rect = self.rect
+        if self.yscroll:
+            ydist = rect.centery - pos[1]
+
+            if ydist == 1 or ydist == -1:
+                ydist = 0
+            if ydist < 0:
+                rect.centery += 2
+
+                if ydist < -10:
+                    rect.centery += 2
+                if ydist < -20:
+                    rect.centery += 4
+                if ydist < -self.maxOffset:
+                    rect.centery = pos[1] - self.maxOffset
+
+            elif ydist > 0:
+                rect.centery -= 2
+
+                if ydist > 10:
+                    rect.centery -= 2
+                if ydist > 20:
+                    rect.centery -= 5
+                if ydist > self.maxOffset:
+                    rect.centery = pos[1] + self.maxOffset
+            if rect.top < 0:
+                rect.top = 0
+            elif rect.bottom > self.ybound:
+                rect.bottom = self.ybound
+        if self.xscroll:
+            rect.centerx = pos[0]
+
+            if rect.left < 0:
+                rect.left = 0
+            elif rect.right > self.xbound:
+                rect.right = self.xbound
+
+        event = CameraMoveEvent.acquire(self.rect.topleft)
+        self.evManager.Post(event)
+
+    def interpolate(self, alpha):
+        """Return the camera's (left, top) between the last two steps."""
+        left, top = self.previous
+        return (left + (self.rect.left - left) * alpha,
+                top + (self.rect.top - top) * alpha)
+
+    def Notify(self, event):
+        if event.name == 'TickEvent':
+            self.previous = self.rect.topleft
+        elif event.name == 'CameraCenterRequest':
+            self.centerOn(event.pos)
+        elif event.name == 'LevelBuildEvent':
+            self.xbound = event.tiles.width * event.tiles.tileSize
+            self.ybound = event.tiles.height * event.tiles.tileSize